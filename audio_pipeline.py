@@ -0,0 +1,286 @@
+# audio_pipeline.py
+"""
+Аудио для распознавания без временных файлов:
+скачивание из Telegram кусками → stdin ffmpeg → stdout ffmpeg → bytes в памяти → загрузка в STT.
+
+Voice (ogg/opus) в ffmpeg не гоняем — он уже подходит для STT (если не включена обрезка тишины).
+mp4/m4a/mov читать из трубы ffmpeg не умеет (moov-атом часто в конце файла), поэтому для них
+вход пишется в NamedTemporaryFile, который удаляется при выходе из with — даже при ошибке.
+
+Бенчмарк (старый путь с mkstemp vs поток):  python audio_pipeline.py [--seconds 120] [--format m4a]
+"""
+import argparse, json, os, re, subprocess, sys, tempfile, threading, time
+
+CHUNK_SIZE = 64 * 1024
+OGG_EXTS = {".ogg", ".oga", ".opus"}
+SEEK_EXTS = {".m4a", ".mp4", ".mov", ".3gp", ".aac"}  # ffmpeg нужен seek по входу
+FFMPEG_OUT_ARGS = ["-vn", "-ar", "16000", "-ac", "1", "-c:a", "libopus", "-b:a", "32k", "-f", "ogg", "pipe:1"]
+
+
+class AudioPipelineError(RuntimeError):
+    pass
+
+
+class AudioTooLarge(AudioPipelineError):
+    pass
+
+
+def _capped(chunks, max_bytes: int):
+    total = 0
+    for chunk in chunks:
+        total += len(chunk)
+        if max_bytes and total > max_bytes:
+            raise AudioTooLarge(f"больше {max_bytes / (1024 * 1024):.0f} МБ")
+        yield chunk
+
+
+def iter_http(session, url: str, max_bytes: int, timeout: float = 30, chunk_size: int = CHUNK_SIZE):
+    """Потоковое скачивание; обрывает соединение, как только перевалили за max_bytes."""
+    with session.get(url, stream=True, timeout=timeout) as resp:
+        resp.raise_for_status()
+        length = int(resp.headers.get("Content-Length") or 0)
+        if max_bytes and length > max_bytes:
+            raise AudioTooLarge(f"больше {max_bytes / (1024 * 1024):.0f} МБ")
+        yield from _capped(resp.iter_content(chunk_size), max_bytes)
+
+
+def iter_file(path: str, max_bytes: int = 0, chunk_size: int = CHUNK_SIZE):
+    with open(path, "rb") as f:
+        yield from _capped(iter(lambda: f.read(chunk_size), b""), max_bytes)
+
+
+def silence_filter(threshold_db: float = -45, min_pause: float = 0.7, keep: float = 0.25) -> str:
+    """
+    Фильтр ffmpeg: срезает тишину в начале и в конце, а паузы длиннее min_pause внутри
+    сжимает до keep секунд — слова не склеиваются, но за тишину не платим.
+    """
+    return (
+        f"silenceremove=start_periods=1:start_threshold={threshold_db}dB:start_silence={keep}"
+        f":stop_periods=-1:stop_duration={min_pause}:stop_threshold={threshold_db}dB:stop_silence={keep}"
+    )
+
+
+def ogg_opus_duration(data: bytes) -> float:
+    """Длительность ogg/opus в секундах: granule position последней страницы (48 кГц) минус pre-skip."""
+    head = data.find(b"OpusHead")
+    pre_skip = int.from_bytes(data[head + 10:head + 12], "little") if head >= 0 else 0
+    pos, granule = 0, 0
+    while data[pos:pos + 4] == b"OggS" and pos + 27 <= len(data):
+        nseg = data[pos + 26]
+        g = int.from_bytes(data[pos + 6:pos + 14], "little", signed=True)
+        if g >= 0:  # -1 — на странице не закончился ни один пакет
+            granule = g
+        pos += 27 + nseg + sum(data[pos + 27:pos + 27 + nseg])
+    return max(0.0, (granule - pre_skip) / 48000)
+
+
+def _run_ffmpeg(input_arg: str, feed, max_out_bytes: int, timeout: float, audio_filter: str = None,
+                input_args: list = None) -> bytes:
+    """
+    ffmpeg -i <input_arg> → ogg/opus в stdout. feed — итератор кусков для stdin (или None).
+    Процесс убивается при любом выходе: ошибка, превышение размера, таймаут.
+    """
+    proc = subprocess.Popen(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error"] + (["-nostdin"] if feed is None else [])
+        + (input_args or []) + ["-i", input_arg] + (["-af", audio_filter] if audio_filter else []) + FFMPEG_OUT_ARGS,
+        stdin=subprocess.PIPE if feed is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    feed_error, stderr_tail = [], []
+
+    def _feed():
+        try:
+            for chunk in feed:
+                proc.stdin.write(chunk)
+        except BrokenPipeError:
+            pass  # ffmpeg сам завершился — причину покажет код возврата
+        except Exception as e:
+            feed_error.append(e)
+        finally:
+            try:
+                proc.stdin.close()
+            except Exception:
+                pass
+
+    def _drain_stderr():
+        for line in proc.stderr:
+            stderr_tail.append(line)
+            del stderr_tail[:-20]
+
+    threads = [threading.Thread(target=_drain_stderr, daemon=True)]
+    if feed is not None:
+        threads.append(threading.Thread(target=_feed, daemon=True))
+    for t in threads:
+        t.start()
+    killer = threading.Timer(timeout, proc.kill)
+    killer.start()
+
+    out, total = bytearray(), 0
+    try:
+        for chunk in iter(lambda: proc.stdout.read(CHUNK_SIZE), b""):
+            total += len(chunk)
+            if max_out_bytes and total > max_out_bytes:
+                raise AudioTooLarge(f"после перекодирования больше {max_out_bytes / (1024 * 1024):.0f} МБ")
+            out += chunk
+        proc.wait()
+    finally:
+        killer.cancel()
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        for t in threads:
+            t.join(timeout=5)
+        proc.stdout.close()
+        proc.stderr.close()
+
+    if feed_error:
+        raise feed_error[0]
+    if proc.returncode != 0:
+        err = b"".join(stderr_tail).decode("utf-8", "replace").strip()
+        raise AudioPipelineError(f"ffmpeg rc={proc.returncode}: {err[-300:]}")
+    return bytes(out)
+
+
+def to_stt_ogg(chunks, ext: str, max_out_bytes: int = 0, timeout: float = 120, audio_filter: str = None) -> bytes:
+    """Куски исходного файла → ogg/opus 16kHz mono (bytes) для загрузки в STT; audio_filter — напр. silence_filter()."""
+    ext = (ext or "").lower()
+    if ext in OGG_EXTS and not audio_filter:
+        data = b"".join(_capped(chunks, max_out_bytes))
+        if not data:
+            raise AudioPipelineError("пустой файл")
+        return data
+    if ext in SEEK_EXTS:
+        with tempfile.NamedTemporaryFile(prefix="audio_", suffix=ext) as tmp:
+            for chunk in chunks:
+                tmp.write(chunk)
+            tmp.flush()
+            return _run_ffmpeg(tmp.name, None, max_out_bytes, timeout, audio_filter)
+    return _run_ffmpeg("pipe:0", chunks, max_out_bytes, timeout, audio_filter)
+
+
+# ===== Нарезка длинного аудио =====
+_SILENCE_RE = re.compile(r"silence_(start|end): (-?[\d.]+)")
+_WORD_RE = re.compile(r"\w+")
+
+
+def silence_points(ogg: bytes, threshold_db: float = -40, min_silence: float = 0.4, timeout: float = 60) -> list:
+    """Середины пауз (в секундах) по silencedetect — там и режем, чтобы не рвать слова."""
+    res = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-nostats", "-i", "pipe:0",
+         "-af", f"silencedetect=noise={threshold_db}dB:d={min_silence}", "-f", "null", "-"],
+        input=ogg, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout,
+    )
+    points, start = [], None
+    for kind, value in _SILENCE_RE.findall(res.stderr.decode("utf-8", "replace")):
+        if kind == "start":
+            start = max(0.0, float(value))
+        elif start is not None:
+            points.append((start + float(value)) / 2)
+            start = None
+    return points
+
+
+def plan_chunks(duration: float, silences: list, target: float = 60, max_len: float = 90, overlap: float = 1.5) -> list:
+    """
+    [(начало, конец)] в секундах. Режем в паузе, ближайшей к target; если пауз нет —
+    жёстко на target. Соседние куски перекрываются на overlap — слово на стыке попадёт в оба,
+    лишнее потом убирает merge_overlap.
+    """
+    chunks, start = [], 0.0
+    while duration - start > max_len:
+        lo, hi = start + target / 2, start + max_len
+        cands = [p for p in silences if lo <= p <= hi]
+        cut = min(cands, key=lambda p: abs(p - start - target)) if cands else start + target
+        chunks.append((start, cut + overlap / 2))
+        start = cut - overlap / 2
+    chunks.append((start, duration))
+    return chunks
+
+
+def cut_ogg(ogg: bytes, start: float, end: float, timeout: float = 60) -> bytes:
+    """Кусок [start, end) из ogg/opus — тоже ogg/opus 16kHz mono."""
+    return _run_ffmpeg("pipe:0", iter([ogg]), 0, timeout, input_args=["-ss", f"{start:.2f}", "-to", f"{end:.2f}"])
+
+
+def merge_overlap(left: str, right: str, max_words: int = 12) -> str:
+    """
+    Склеивает расшифровки соседних кусков, выкидывая из right начало, повторяющее хвост left.
+    Совпадение одного слова не считаем перекрытием: «и … и», «что … что» — обычная речь, а не повтор.
+    """
+    if not left or not right:
+        return left or right
+    right_words = right.split()
+    norm = lambda words: [" ".join(_WORD_RE.findall(w.lower())) for w in words]
+    tail, head = norm(left.split()[-max_words:]), norm(right_words[:max_words])
+    for k in range(min(len(tail), len(head)), 1, -1):
+        if tail[-k:] == head[:k]:
+            rest = " ".join(right_words[k:])
+            return f"{left} {rest}" if rest else left
+    return f"{left} {right}"
+
+
+# ===== Бенчмарк =====
+def _old_path(src: str) -> bytes:
+    """Как было в main.py: весь файл в память → mkstemp → ffmpeg файл-в-файл → чтение для загрузки."""
+    with open(src, "rb") as f:
+        raw = f.read()  # bot.download_file
+    fd, path = tempfile.mkstemp(prefix="audio_", suffix=os.path.splitext(src)[1])
+    os.close(fd)
+    with open(path, "wb") as out:
+        out.write(raw)
+    out_path = os.path.splitext(path)[0] + ".ogg"
+    subprocess.run(["ffmpeg", "-y", "-i", path, "-ar", "16000", "-ac", "1", "-c:a", "libopus", out_path],
+                   check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    with open(out_path, "rb") as f:
+        data = f.read()  # open(path, "rb") в transcriptions.create
+    os.remove(path)  # в боте их никто не удалял; тут чистим, чтобы не мусорить
+    os.remove(out_path)
+    return data
+
+
+def _new_path(src: str) -> bytes:
+    return to_stt_ogg(iter_file(src), os.path.splitext(src)[1])
+
+
+def _run_variant(variant: str, src: str):
+    import resource
+    t0 = time.perf_counter()
+    data = (_old_path if variant == "old" else _new_path)(src)
+    wall = time.perf_counter() - t0
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"wall": wall, "rss_kb": rss_kb, "out": len(data)}))
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Бенчмарк: временные файлы vs потоковый пайплайн")
+    ap.add_argument("--seconds", type=int, default=120)
+    ap.add_argument("--format", default="mp3", choices=["mp3", "m4a", "wav", "ogg"])
+    ap.add_argument("--runs", type=int, default=3)
+    ap.add_argument("--variant", choices=["old", "new"], help=argparse.SUPPRESS)
+    ap.add_argument("--input", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.variant:
+        return _run_variant(args.variant, args.input)
+
+    with tempfile.TemporaryDirectory() as d:
+        src = os.path.join(d, f"sample.{args.format}")
+        subprocess.run(["ffmpeg", "-y", "-f", "lavfi", "-i", f"sine=frequency=440:duration={args.seconds}",
+                        "-ac", "2", "-ar", "44100", src], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        print(f"Вход: {args.seconds} с {args.format}, {os.path.getsize(src) / 1024:.0f} КБ; прогонов: {args.runs}")
+        print(f"{'вариант':>8} | {'время, с':>9} | {'пик RSS, МБ':>12} | {'ogg, КБ':>8}")
+        for variant in ("old", "new"):
+            # каждый прогон в отдельном процессе — ru_maxrss считается за всю жизнь процесса
+            runs = []
+            for _ in range(args.runs):
+                res = subprocess.run([sys.executable, os.path.abspath(__file__), "--variant", variant, "--input", src],
+                                     check=True, capture_output=True, text=True)
+                runs.append(json.loads(res.stdout.strip().splitlines()[-1]))
+            wall = sorted(r["wall"] for r in runs)[len(runs) // 2]
+            rss = max(r["rss_kb"] for r in runs) / 1024
+            print(f"{variant:>8} | {wall:>9.2f} | {rss:>12.1f} | {runs[0]['out'] / 1024:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+# idiom_matcher.py
+"""
+Поиск идиом/сленга в тексте за один проход (автомат Ахо–Корасик)
+по нормализованному ивриту (та же норма, что в dedupe_phrases.norm_he).
+
+Словарь можно держать в JSON-файле — он перечитывается на лету при изменении.
+Формат файла: {"יאללה": "пояснение", ...} или [{"he": "...", "note": "..."}, ...]
+
+Бенчмарк (наивный цикл vs автомат):  python idiom_matcher.py
+"""
+import json, os, random, threading, time
+from collections import deque
+from dedupe_phrases import norm_he
+
+
+def norm_idiom(s: str) -> str:
+    return " ".join(norm_he(s).split())
+
+
+class IdiomAutomaton:
+    """Бор + суффиксные ссылки; find() — один проход по тексту, стоимость не зависит от размера словаря."""
+
+    def __init__(self, idioms: dict):
+        self.idioms = dict(idioms)
+        self._goto = [{}]   # узел -> {символ: узел}
+        self._fail = [0]
+        self._out = [[]]    # узел -> [ключи идиом, заканчивающихся здесь]
+        for key in self.idioms:
+            pattern = norm_idiom(key)
+            if not pattern:
+                continue
+            node = 0
+            for ch in pattern:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                node = nxt
+            self._out[node].append(key)
+        self._build_fail_links()
+
+    def _build_fail_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                cand = self._goto[f].get(ch, 0)
+                self._fail[nxt] = cand if cand != nxt else 0
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def find(self, text: str) -> list:
+        """Все найденные идиомы [(ключ, пояснение)] в порядке первого появления, без повторов."""
+        node, seen, hits = 0, set(), []
+        goto, fail, out = self._goto, self._fail, self._out
+        for ch in norm_idiom(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for key in out[node]:
+                if key not in seen:
+                    seen.add(key)
+                    hits.append((key, self.idioms[key]))
+        return hits
+
+
+def load_idioms_file(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        return {str(k): str(v) for k, v in data.items() if k and v}
+    if isinstance(data, list):
+        return {x["he"]: x.get("note") or x.get("ru") or "" for x in data if isinstance(x, dict) and x.get("he")}
+    raise ValueError("idioms file должен быть объектом или списком")
+
+
+class IdiomMatcher:
+    """
+    Встроенный словарь + (опционально) JSON-файл поверх него.
+    Раз в check_every секунд смотрим mtime файла и пересобираем автомат, если он изменился.
+    """
+
+    def __init__(self, path: str, builtin: dict, check_every: float = 5.0):
+        self.path = path
+        self.builtin = dict(builtin)
+        self.check_every = check_every
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked_at = 0.0
+        self._automaton = IdiomAutomaton(self.builtin)
+        self._maybe_reload(force=True)
+
+    @property
+    def idioms(self) -> dict:
+        self._maybe_reload()
+        return self._automaton.idioms
+
+    def _maybe_reload(self, force: bool = False):
+        now = time.time()
+        if not force and now - self._checked_at < self.check_every:
+            return
+        with self._lock:
+            self._checked_at = now
+            try:
+                mtime = os.path.getmtime(self.path) if self.path else None
+            except OSError:
+                mtime = None
+            if mtime == self._mtime:
+                return
+            self._mtime = mtime
+            merged = dict(self.builtin)
+            if mtime is not None:
+                try:
+                    merged.update(load_idioms_file(self.path))
+                except Exception as e:
+                    print(f"[idioms] не смогла прочитать {self.path}: {e}")
+                    return
+            self._automaton = IdiomAutomaton(merged)
+            print(f"[idioms] словарь: {len(merged)} шт. (файл: {self.path if mtime else 'нет'})")
+
+    def find(self, text: str) -> list:
+        self._maybe_reload()
+        return self._automaton.find(text)
+
+
+# ===== Бенчмарк =====
+def _naive_find(idioms: dict, text: str) -> list:
+    """Старый вариант из explain_local: replace + подстрока на каждую идиому."""
+    low = text.replace("׳", "").replace("'", "")
+    hits = []
+    for k, note in idioms.items():
+        kk = k.replace("׳", "").replace("'", "")
+        if kk in low:
+            hits.append((k, note))
+    return hits
+
+
+def _random_word(rnd, lo=2, hi=6):
+    return "".join(rnd.choice("אבגדהוזחטיכלמנסעפצקרשת") for _ in range(rnd.randint(lo, hi)))
+
+
+def main():
+    rnd = random.Random(42)
+    texts = [" ".join(_random_word(rnd) for _ in range(60)) for _ in range(50)]  # ~300 символов
+    print(f"{'словарь':>8} | {'сборка, мс':>10} | {'наивно, мкс/текст':>18} | {'автомат, мкс/текст':>19}")
+    for size in (10, 100, 1000, 5000):
+        idioms = {}
+        while len(idioms) < size:
+            phrase = " ".join(_random_word(rnd) for _ in range(rnd.randint(1, 3)))
+            idioms[phrase] = "note"
+
+        t0 = time.perf_counter()
+        automaton = IdiomAutomaton(idioms)
+        build_ms = (time.perf_counter() - t0) * 1000
+
+        t0 = time.perf_counter()
+        for t in texts:
+            _naive_find(idioms, t)
+        naive_us = (time.perf_counter() - t0) / len(texts) * 1e6
+
+        t0 = time.perf_counter()
+        for t in texts:
+            automaton.find(t)
+        ac_us = (time.perf_counter() - t0) / len(texts) * 1e6
+
+        print(f"{size:>8} | {build_ms:>10.1f} | {naive_us:>18.0f} | {ac_us:>19.0f}")
+
+
+if __name__ == "__main__":
+    main()
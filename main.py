@@ -12,7 +12,6 @@ import hashlib
 from datetime import date
 from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
-import subprocess, tempfile
 from telebot import types
 BASE_DIR = os.path.dirname(__file__)
 
@@ -35,9 +34,7 @@ tz = pytz.timezone('Asia/Jerusalem')
 # OpenAI
 from openai import (
     OpenAI,
-    APIConnectionError,
     RateLimitError,
-    APIStatusError,
     AuthenticationError,
     BadRequestError,
 )
@@ -224,28 +221,228 @@ def already_sent_today(db, chat_id: int, kind: str) -> bool:
         return True
 
 # ===== USERS: автокарточка и подписки по умолчанию =====
+USER_SEEN_FLUSH_SEC = float(os.getenv("USER_SEEN_FLUSH_SEC", "300"))  # last_seen пишем не чаще раза в N секунд
+USER_PROFILE_TTL = float(os.getenv("USER_PROFILE_TTL", "3600"))
+
+class UserProfiles:
+    """
+    Карточки users/{uid} в памяти. Настоящие изменения (имя, подписки, blocked, last_pod/last_fact)
+    пишутся сразу (write-through); last_seen только копится и уходит пачкой раз в flush_every секунд —
+    одна запись на пользователя за период вместо записи на каждое сообщение.
+    """
+
+    def __init__(self, flush_every: float, ttl: float):
+        self.flush_every = flush_every
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._docs = {}   # uid -> (expires_at, dict)
+        self._seen = {}   # uid -> last_seen ISO, ещё не записанный
+        self._cards = {}  # uid -> имена: карточку надо проверить при flush (создать / дописать подписки)
+        self.stats = {"reads": 0, "writes": 0, "seen_flushed": 0, "created": 0, "errors": 0}
+        threading.Thread(target=self._loop, daemon=True, name="users-flush").start()
+
+    @staticmethod
+    def _ref(user_id):
+        return db.collection("users").document(str(user_id))
+
+    def _cached(self, uid: str):
+        with self._lock:
+            entry = self._docs.get(uid)
+        return entry[1] if entry and entry[0] > time.time() else None
+
+    def _store(self, uid: str, doc: dict):
+        with self._lock:
+            self._docs[uid] = (time.time() + self.ttl, doc)
+
+    def get(self, user_id) -> dict:
+        """Карточка пользователя ({} если её нет); из памяти, при промахе — одно чтение."""
+        uid = str(user_id)
+        doc = self._cached(uid)
+        if doc is not None:
+            return doc
+        snap = self._ref(uid).get()
+        self.stats["reads"] += 1
+        doc = (snap.to_dict() or {}) if snap.exists else {}
+        self._store(uid, doc)
+        return doc
+
+    def prime(self, user_id, snap):
+        """Документ, прочитанный пачкой (UpdateContext), кладём в память без своего чтения."""
+        self._store(str(user_id), (snap.to_dict() or {}) if snap.exists else {})
+
+    def set_fields(self, user_id, fields: dict, ctx=None):
+        """Write-through: сразу в Firestore (или в batch контекста апдейта) и в память."""
+        uid = str(user_id)
+        if ctx is not None:
+            ctx.write(self._ref(uid), fields)
+        else:
+            self._ref(uid).set(fields, merge=True)
+        self.stats["writes"] += 1
+        cached = self._cached(uid)
+        if cached is None:
+            # полной карточки в памяти нет — частичную не кладём: get() увидел бы её как всю карточку
+            # (недостающая подписка = True), а touch() дописал бы это «по умолчанию» в Firestore
+            with self._lock:
+                self._docs.pop(uid, None)
+            return
+        self._store(uid, {**cached, **fields})
+
+    @staticmethod
+    def _names(user) -> dict:
+        return {
+            "username": user.username or "",
+            "first_name": user.first_name or "",
+            "last_name": user.last_name or "",
+        }
+
+    @staticmethod
+    def _card_fields(doc: dict, names: dict) -> dict:
+        """Что дописать в карточку: сменившиеся имена и подписки по умолчанию, если этих полей ещё нет."""
+        fields = {k: v for k, v in names.items() if doc.get(k) != v}
+        # только отсутствующие поля — выбор пользователя не затираем
+        fields.update({k: True for k in ("sub_pod", "sub_fact") if k not in doc})
+        return fields
+
+    def mark_seen(self, user):
+        """
+        last_seen без чтения карточки (для сообщений, отсеянных локальными проверками).
+        Если карточки нет в памяти или она неполная — при flush прочитаем её пачкой и допишем
+        имена и подписки: голый {"last_seen"} выпал бы из рассылок фразы и факта дня.
+        """
+        uid = str(user.id)
+        names = self._names(user)
+        doc = self._cached(uid)
+        with self._lock:
+            self._seen[uid] = datetime.now(timezone.utc).isoformat()
+            if doc is None or self._card_fields(doc, names):
+                self._cards[uid] = names
+
+    def touch(self, user, ctx=None):
+        """Пользователь что-то прислал: создать карточку, если её нет, обновить имя, если сменилось, отметить last_seen."""
+        uid = str(user.id)
+        now_iso = datetime.now(timezone.utc).isoformat()
+        try:
+            doc = self.get(uid)
+            fields = self._card_fields(doc, self._names(user))
+            with self._lock:
+                self._cards.pop(uid, None)  # карточку только что проверили — mark_seen её больше не ждёт
+            if fields:
+                if not doc:
+                    self.stats["created"] += 1
+                self.set_fields(uid, {**fields, "last_seen": now_iso}, ctx)
+                with self._lock:
+                    self._seen.pop(uid, None)  # свежий last_seen уже ушёл — старый из mark_seen не нужен
+                return
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"[users] {uid}: {e}")
+        with self._lock:
+            self._seen[uid] = now_iso
+
+    def _requeue(self, items, cards: dict):
+        with self._lock:
+            for uid, fields in items:
+                self._seen.setdefault(uid, fields["last_seen"])  # более свежий уже мог прийти
+                if uid in cards:
+                    self._cards.setdefault(uid, cards[uid])
+
+    def _resolve_cards(self, cards: dict) -> dict:
+        """Одним get_all читаем карточки, которых нет в памяти; uid -> поля, которые надо дописать."""
+        out, cold = {}, []
+        for uid, names in cards.items():
+            doc = self._cached(uid)  # с момента mark_seen карточку мог прочитать UpdateContext
+            if doc is None:
+                cold.append(uid)
+                continue
+            out[uid] = self._card_fields(doc, names)
+            if out[uid]:
+                self._store(uid, {**doc, **out[uid]})
+        if not cold:
+            return out
+        snaps = db.get_all([self._ref(uid) for uid in cold])
+        self.stats["reads"] += 1
+        for snap in snaps:
+            doc = (snap.to_dict() or {}) if snap.exists else {}
+            fields = self._card_fields(doc, cards[snap.id])
+            if not doc:
+                self.stats["created"] += 1
+            self._store(snap.id, {**doc, **fields})
+            out[snap.id] = fields
+        return out
+
+    def flush(self) -> int:
+        with self._lock:
+            seen, self._seen = self._seen, {}
+            cards, self._cards = self._cards, {}
+        card_fields = {}
+        if cards:
+            try:
+                card_fields = self._resolve_cards(cards)
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"[users] чтение карточек err: {e}")
+                # без проверенной карточки last_seen не пишем — иначе появится документ без подписок
+                self._requeue([(uid, {"last_seen": seen.pop(uid)}) for uid in cards if uid in seen], cards)
+        items = [(uid, {**card_fields.get(uid, {}), "last_seen": iso}) for uid, iso in seen.items()]
+        written = 0
+        for i in range(0, len(items), _FIRESTORE_BATCH_MAX):
+            part = items[i:i + _FIRESTORE_BATCH_MAX]
+            try:
+                batch = db.batch()
+                for uid, fields in part:
+                    batch.set(self._ref(uid), fields, merge=True)
+                batch.commit()
+                written += len(part)
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"[users] flush last_seen err: {e}")
+                self._requeue(part, cards)
+        self.stats["seen_flushed"] += written
+        return written
+
+    def prune(self) -> int:
+        """Выкидываем протухшие карточки — иначе _docs растёт на каждого, кто хоть раз писал."""
+        now = time.time()
+        with self._lock:
+            dead = [uid for uid, (exp, _) in self._docs.items() if exp <= now]
+            for uid in dead:
+                del self._docs[uid]
+        return len(dead)
+
+    def _loop(self):
+        while True:
+            time.sleep(self.flush_every)
+            try:
+                self.flush()
+                self.prune()
+                premium_cache.prune()
+            except Exception as e:
+                print(f"[users] loop err: {e}")
+
+    def stats_line(self) -> str:
+        s = self.stats
+        return (f"users: в памяти {len(self._docs)}, ждут last_seen {len(self._seen)}, чтений {s['reads']}, "
+                f"записей {s['writes']} (новых {s['created']}), last_seen пачками {s['seen_flushed']}, ошибок {s['errors']}")
+
+user_profiles = UserProfiles(USER_SEEN_FLUSH_SEC, USER_PROFILE_TTL)
+
 def _ensure_user(user):
-    """Создает/обновляет запись пользователя в Firebase"""
-    uid = str(user.id)
-    db.collection("users").document(uid).set({
-        "username": user.username or "",
-        "first_name": user.first_name or "",
-        "last_name": user.last_name or "",
-        "sub_pod": True,  # Фраза дня: по умолчанию включена
-        "sub_fact": True,  # Факт дня: по умолчанию включён
-        "last_seen": datetime.now(timezone.utc).isoformat(),
-    }, merge=True)
+    """Создает/обновляет запись пользователя (через кэш карточек)"""
+    user_profiles.touch(user)
 
 def _send_explanation_guard(chat_id: int, body: str, offline: bool = False):
     """
     Если ответ получился целиком на иврите — всё равно отправим,
     но добавим подсказку. Иначе — как обычно.
     """
+    bot.send_message(chat_id, _explanation_text(body, offline))
+
+def _explanation_text(body: str, offline: bool = False) -> str:
     if contains_hebrew(body) and not contains_cyrillic(body):
         body = "⚠️ Похоже, объяснение пришло на иврите. Нажмите «🧠 Объяснить» ещё раз — нужен ответ по-русски.\n\n" + body
 
     prefix = "🧠 Объяснение (офлайн):\n" if offline else "🧠 Объяснение:\n"
-    bot.send_message(chat_id, prefix + body)
+    return prefix + body
 
 # ===== ДОСТУП: только ID из allowed_users =====
 ALLOWED_USERS = set()
@@ -305,115 +502,392 @@ def _usage_doc_ref(user_id: int, date_iso: str):
 def _today_iso():
     return datetime.now(tz).date().isoformat()
 
-def get_usage(user_id: int) -> dict:
-    today = _today_iso()
-    try:
-        ref = _usage_doc_ref(user_id, today)
-        snap = ref.get()
-        if snap.exists:
-            d = snap.to_dict()
-        else:
-            d = {"text": 0, "audio": 0, "text_chars": 0, "audio_secs": 0}
-            ref.set(d)
-        
-        d.setdefault("text", 0)
-        d.setdefault("audio", 0)
-        d.setdefault("text_chars", 0)
-        d.setdefault("audio_secs", 0)
-        return d
-    except Exception:
-        # локальный фолбэк
-        global _LOCAL_USAGE
+# ---- Учёт использования: счётчики дня в памяти, в Firestore — пачками ----
+USAGE_FIELDS = ("text", "audio", "text_chars", "audio_secs")
+USAGE_FLUSH_SEC = float(os.getenv("USAGE_FLUSH_SEC", "10"))
+_FIRESTORE_BATCH_MAX = 450  # лимит Firestore — 500 операций на batch
+
+class UsageLedger:
+    """
+    Счётчики дня по каждому пользователю живут в памяти — проверка лимита это поиск в словаре.
+    Первая встреча пользователя за день — одно чтение usage/{uid}_{дата} (вдруг был рестарт).
+    Изменения копятся дельтами и раз в flush_every секунд уходят одним batch
+    с firestore.Increment: ничего не перезаписываем, поэтому параллельный инстанс не теряет свои +1.
+    """
+
+    def __init__(self, flush_every: float):
+        self.flush_every = flush_every
+        self._lock = threading.Lock()
+        self._day = _today_iso()
+        self._counters = {}  # user_id -> {поле: значение} за self._day
+        self._deltas = {}    # (user_id, дата) -> {поле: ещё не записанная дельта}
+        self.stats = {"loads": 0, "load_errors": 0, "flushes": 0, "docs_written": 0, "flush_errors": 0}
+        threading.Thread(target=self._loop, daemon=True, name="usage-flush").start()
+
+    def _roll_day(self):
+        today = _today_iso()
+        if today != self._day:
+            self._day, self._counters = today, {}
+
+    def _load(self, user_id: int, day: str) -> dict:
+        d = dict.fromkeys(USAGE_FIELDS, 0)
         try:
-            _LOCAL_USAGE
-        except NameError:
-            _LOCAL_USAGE = {}
-        
-        info = _LOCAL_USAGE.setdefault(user_id, {})
-        if info.get("date") != today:
-            info.update({"date": today, "text": 0, "audio": 0, "text_chars": 0, "audio_secs": 0})
-        return info
+            snap = _usage_doc_ref(user_id, day).get()
+            if snap.exists:
+                d.update({k: int(v) for k, v in (snap.to_dict() or {}).items() if k in USAGE_FIELDS})
+            self.stats["loads"] += 1
+        except Exception as e:
+            print(f"[usage] не смогла прочитать {user_id}_{day}: {e} — считаю с нуля")
+            self.stats["load_errors"] += 1
+        return d
 
-def save_usage(user_id: int, data: dict):
-    today = _today_iso()
-    try:
-        _usage_doc_ref(user_id, today).set(data, merge=True)
-    except Exception:
-        global _LOCAL_USAGE
-        _LOCAL_USAGE[user_id] = {**_LOCAL_USAGE.get(user_id, {}), **data, "date": today}
+    def _counters_for(self, user_id: int) -> dict:
+        """Счётчики пользователя за сегодня; вызывать без self._lock — может сходить в Firestore."""
+        with self._lock:
+            self._roll_day()
+            d = self._counters.get(user_id)
+            day = self._day
+        if d is not None:
+            return d
+        loaded = self._load(user_id, day)
+        with self._lock:
+            if day != self._day:  # пока читали, наступила полночь
+                return self._counters.setdefault(user_id, dict.fromkeys(USAGE_FIELDS, 0))
+            return self._counters.setdefault(user_id, loaded)
+
+    def needs_load(self, user_id: int):
+        """Дата, за которую счётчиков пользователя ещё нет в памяти (None — уже есть)."""
+        with self._lock:
+            self._roll_day()
+            return None if user_id in self._counters else self._day
+
+    def prime(self, user_id: int, day: str, snap):
+        d = dict.fromkeys(USAGE_FIELDS, 0)
+        if snap.exists:
+            d.update({k: int(v) for k, v in (snap.to_dict() or {}).items() if k in USAGE_FIELDS})
+        with self._lock:
+            if day == self._day:
+                self._counters.setdefault(user_id, d)
+                self.stats["loads"] += 1
+
+    def get(self, user_id: int) -> dict:
+        d = self._counters_for(user_id)
+        with self._lock:
+            return dict(d)
+
+    def _apply(self, user_id: int, d: dict, field: str, amount: int):
+        """Под self._lock: меняем счётчик и копим дельту для записи."""
+        amount = max(amount, -d[field])  # в минус не уходим
+        if not amount:
+            return
+        d[field] += amount
+        delta = self._deltas.setdefault((user_id, self._day), {})
+        delta[field] = delta.get(field, 0) + amount
+
+    def add(self, user_id: int, field: str, amount: int):
+        d = self._counters_for(user_id)
+        with self._lock:
+            self._apply(user_id, d, field, amount)
+
+    def add_all(self, user_id: int, checks: dict) -> tuple[bool, str, dict]:
+        """
+        checks: {поле: (сколько списать, лимит)}. Все поля проверяются и списываются вместе под одной
+        блокировкой — либо всё, либо ничего. Возвращает (ок, поле, упёршееся в лимит, копия счётчиков).
+        """
+        d = self._counters_for(user_id)
+        with self._lock:
+            for field, (amount, limit) in checks.items():
+                if d[field] + amount > limit:
+                    return False, field, dict(d)
+            for field, (amount, _) in checks.items():
+                self._apply(user_id, d, field, amount)
+            return True, "", dict(d)
+
+    def flush(self) -> int:
+        with self._lock:
+            deltas, self._deltas = self._deltas, {}
+        items = [(k, v) for k, v in deltas.items() if any(v.values())]
+        written = 0
+        for i in range(0, len(items), _FIRESTORE_BATCH_MAX):
+            part = items[i:i + _FIRESTORE_BATCH_MAX]
+            try:
+                batch = db.batch()
+                for (user_id, day), delta in part:
+                    batch.set(_usage_doc_ref(user_id, day),
+                              {k: firestore.Increment(v) for k, v in delta.items() if v}, merge=True)
+                batch.commit()
+                written += len(part)
+            except Exception as e:
+                print(f"[usage] flush err: {e} — повторю в следующий раз")
+                self.stats["flush_errors"] += 1
+                with self._lock:
+                    for key, delta in part:  # возвращаем дельты, чтобы не потерять
+                        cur = self._deltas.setdefault(key, {})
+                        for k, v in delta.items():
+                            cur[k] = cur.get(k, 0) + v
+        if written:
+            self.stats["flushes"] += 1
+            self.stats["docs_written"] += written
+        return written
+
+    def _loop(self):
+        while True:
+            time.sleep(self.flush_every)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"[usage] loop err: {e}")
+
+    def stats_line(self) -> str:
+        s = self.stats
+        with self._lock:
+            pending = len(self._deltas)
+            users = len(self._counters)
+        return (f"usage: пользователей сегодня {users}, ждут записи {pending}, чтений {s['loads']} "
+                f"(ошибок {s['load_errors']}), сбросов {s['flushes']} / документов {s['docs_written']}, "
+                f"ошибок записи {s['flush_errors']}")
+
+usage_ledger = UsageLedger(USAGE_FLUSH_SEC)
+
+def get_usage(user_id: int) -> dict:
+    """Копия счётчиков за сегодня (из памяти)."""
+    return usage_ledger.get(user_id)
 
 # ===== PREMIUM (ручное включение по чеку) =====
+# Статус меняется раз в месяц, а спрашиваем его на каждом сообщении — держим документы в памяти.
+# Кэшируем сам документ, а не bool: срок until проверяется при каждом вызове.
+PREMIUM_CACHE_TTL = float(os.getenv("PREMIUM_CACHE_TTL", "600"))
+PREMIUM_NEG_TTL = float(os.getenv("PREMIUM_NEG_TTL", "300"))
+PREMIUM_LISTENER = os.getenv("PREMIUM_LISTENER", "1") == "1"
+
+class PremiumCache:
+    """
+    premium_users/{uid} в памяти: положительные и отрицательные ответы с TTL.
+    Если работает on_snapshot-слушатель, вся коллекция (она маленькая) лежит в памяти
+    и обновляется пушем — тогда «нет документа» значит «не премиум» без чтения.
+    Пушнутые записи тоже с TTL: если слушатель умрёт, они устареют и перечитаются, а не живут вечно.
+    """
+
+    def __init__(self):
+        self._docs = {}  # uid -> (expires_at, dict | None)
+        self._lock = threading.Lock()
+        self._watch = None
+        self.live = False
+        self.stats = {"hits": 0, "misses": 0, "errors": 0, "pushes": 0}
+
+    def _is_live(self) -> bool:
+        return self.live and self._watch is not None and getattr(self._watch, "is_active", True)
+
+    def get_doc(self, user_id: int):
+        now = time.time()
+        live = self._is_live()
+        with self._lock:
+            entry = self._docs.get(user_id)
+        if live or (entry and entry[0] > now):
+            self.stats["hits"] += 1
+            return entry[1] if entry else None
+        self.stats["misses"] += 1
+        try:
+            snap = db.collection("premium_users").document(str(user_id)).get()
+            doc = (snap.to_dict() or {}) if snap.exists else None
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"[premium] чтение {user_id} не удалось: {e}")
+            return entry[1] if entry else None  # лучше устаревший ответ, чем «не премиум» у платившего
+        self.put(user_id, doc)
+        return doc
+
+    def needs_read(self, user_id: int) -> bool:
+        if self._is_live():
+            return False
+        with self._lock:
+            entry = self._docs.get(user_id)
+        return not entry or entry[0] <= time.time()
+
+    def prime(self, user_id: int, snap):
+        self.put(user_id, (snap.to_dict() or {}) if snap.exists else None)
+
+    def put(self, user_id: int, doc):
+        ttl = PREMIUM_CACHE_TTL if doc and doc.get("active") else PREMIUM_NEG_TTL
+        with self._lock:
+            self._docs[user_id] = (time.time() + ttl, doc)
+
+    def prune(self) -> int:
+        """
+        Давно протухшие записи — вон (зовётся из цикла users-flush). Ещё один TTL держим:
+        при ошибке чтения get_doc отвечает устаревшей записью. Пока жив слушатель — не трогаем,
+        там память — вся коллекция, и «нет записи» значит «не премиум».
+        """
+        if self._is_live():
+            return 0
+        cutoff = time.time() - PREMIUM_CACHE_TTL
+        with self._lock:
+            dead = [uid for uid, (exp, _) in self._docs.items() if exp <= cutoff]
+            for uid in dead:
+                del self._docs[uid]
+        return len(dead)
+
+    def start_listener(self):
+        try:
+            self._watch = db.collection("premium_users").on_snapshot(self._on_snapshot)
+        except Exception as e:
+            print(f"[premium] слушатель не запустился, работаю по TTL: {e}")
+
+    def _on_snapshot(self, docs, changes, read_time):
+        with self._lock:
+            for change in changes:
+                try:
+                    uid = int(change.document.id)
+                except ValueError:
+                    continue
+                doc = None if change.type.name == "REMOVED" else (change.document.to_dict() or {})
+                self._docs[uid] = (time.time() + PREMIUM_CACHE_TTL, doc)
+                self.stats["pushes"] += 1
+            if not self.live:
+                self.live = True
+                print(f"[premium] слушатель: в памяти {len(docs)} премиум-документов")
+
+    def stats_line(self) -> str:
+        s = self.stats
+        mode = "push" if self._is_live() else "TTL"
+        return (f"premium ({mode}): в памяти {len(self._docs)}, hit {s['hits']}, чтений {s['misses']}, "
+                f"ошибок {s['errors']}, пушей {s['pushes']}")
+
+premium_cache = PremiumCache()
+if PREMIUM_LISTENER:
+    premium_cache.start_listener()
+
+def _premium_active(d) -> bool:
+    if not d or not d.get("active"):
+        return False
+    until = d.get("until")
+    if until:
+        return datetime.now(tz).date().isoformat() <= until
+    return True
+
 def is_premium(user_id: int) -> bool:
     try:
-        doc = db.collection("premium_users").document(str(user_id)).get()
-        d = doc.to_dict() or {}
-        if not d.get("active"):
-            return False
-        
-        until = d.get("until")
-        if until:
-            return datetime.now(tz).date().isoformat() <= until
-        return True
+        return _premium_active(premium_cache.get_doc(int(user_id)))
     except Exception:
         return False
 
-def can_use(user_id: int, kind: str) -> bool:
-    # по 3 шт/день; премиум — безлимит
-    if is_premium(user_id):
-        return True
-    
-    d = get_usage(user_id)
-    if kind == "text":
-        if d["text"] < FREE_LIMIT_TEXT:
-            d["text"] += 1
-            save_usage(user_id, d)
-            return True
-        return False
-    
-    if kind == "audio":
-        if d["audio"] < FREE_LIMIT_AUDIO:
-            d["audio"] += 1
-            save_usage(user_id, d)
-            return True
-        return False
-    
-    return False
+# ===== Контекст апдейта: всё, чего нет в кэшах, — одним get_all =====
+context_stats = {"updates": 0, "batched_reads": 0, "docs_read": 0, "commits": 0, "errors": 0}
 
-def can_use_text_volume(user_id: int, msg_len: int) -> tuple[bool, str]:
-    if is_premium(user_id):
-        if msg_len > 2000:
-            return False, "⚠️ Очень длинное сообщение. Разбей, пожалуйста."
-        return True, ""
-    
-    if msg_len > TEXT_MAX_LEN_PER_MSG:
-        return False, TEXT_TOO_LONG_MSG
-    
-    d = get_usage(user_id)
-    if d["text_chars"] + msg_len > TEXT_MAX_LEN_PER_DAY:
-        left = max(0, TEXT_MAX_LEN_PER_DAY - d["text_chars"])
-        return False, f"🚫 Лимит символов на сегодня исчерпан. Осталось: {left}/{TEXT_MAX_LEN_PER_DAY}. Завтра обнулится."
-    
-    d["text_chars"] += msg_len
-    save_usage(user_id, d)
-    return True, ""
+class UpdateContext:
+    """
+    Собирается в начале обработки сообщения — уже после дешёвых локальных проверок.
+    Карточка users/{uid}, premium_users/{uid} и usage/{uid}_{дата}, которых нет в памяти,
+    читаются одним db.get_all (один round trip вместо трёх подряд) и раскладываются по кэшам.
+    Изменения карточки копятся в одном batch и уходят commit'ом при выходе из with.
+    """
 
-def can_use_audio_volume(user_id: int, duration_sec: int) -> tuple[bool, str]:
-    if is_premium(user_id):
-        if duration_sec > 600:
-            return False, "⚠️ Очень длинное аудио. Сделай короче, пожалуйста."
-        return True, ""
-    
-    if duration_sec > AUDIO_MAX_SEC_PER_MSG:
-        return False, AUDIO_TOO_LONG_MSG
-    
-    d = get_usage(user_id)
-    if d["audio_secs"] + duration_sec > AUDIO_MAX_SEC_PER_DAY:
-        left = max(0, AUDIO_MAX_SEC_PER_DAY - d["audio_secs"])
-        return False, f"🚫 Лимит длительности аудио исчерпан. Осталось: {left} сек. из {AUDIO_MAX_SEC_PER_DAY}. Завтра обнулится."
-    
-    d["audio_secs"] += duration_sec
-    save_usage(user_id, d)
-    return True, ""
+    def __init__(self, user):
+        self.user = user
+        self.user_id = user.id
+        self._batch = None
+        context_stats["updates"] += 1
+        self._prefetch()
+        user_profiles.touch(user, ctx=self)
+
+    def _prefetch(self):
+        uid = self.user_id
+        wanted = {}  # путь документа -> (ref, куда положить снимок)
+        if user_profiles._cached(str(uid)) is None:
+            ref = user_profiles._ref(uid)
+            wanted[ref.path] = (ref, lambda snap: user_profiles.prime(uid, snap))
+        if premium_cache.needs_read(uid):
+            ref = db.collection("premium_users").document(str(uid))
+            wanted[ref.path] = (ref, lambda snap: premium_cache.prime(uid, snap))
+        day = usage_ledger.needs_load(uid)
+        if day:
+            ref = _usage_doc_ref(uid, day)
+            wanted[ref.path] = (ref, lambda snap: usage_ledger.prime(uid, day, snap))
+        if not wanted:
+            return
+        try:
+            for snap in db.get_all([ref for ref, _ in wanted.values()]):
+                wanted[snap.reference.path][1](snap)
+            context_stats["batched_reads"] += 1
+            context_stats["docs_read"] += len(wanted)
+        except Exception as e:
+            # не страшно: каждый кэш при промахе дочитает своё сам
+            context_stats["errors"] += 1
+            print(f"[ctx] get_all для {uid} не удался: {e}")
+
+    @property
+    def premium(self) -> bool:
+        return is_premium(self.user_id)
+
+    @property
+    def profile(self) -> dict:
+        return user_profiles.get(self.user_id)
+
+    @property
+    def usage(self) -> dict:
+        return usage_ledger.get(self.user_id)
+
+    def write(self, ref, fields: dict):
+        if self._batch is None:
+            self._batch = db.batch()
+        self._batch.set(ref, fields, merge=True)
+
+    def commit(self):
+        batch, self._batch = self._batch, None
+        if batch is None:
+            return
+        try:
+            batch.commit()
+            context_stats["commits"] += 1
+        except Exception as e:
+            context_stats["errors"] += 1
+            print(f"[ctx] commit для {self.user_id} не удался: {e}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.commit()
+        return False
+
+def admit(user_id: int, kind: str, amount: int, premium: bool = None) -> tuple[bool, str, dict]:
+    """
+    Допуск одного сообщения: штуки и символы/секунды проверяются и списываются вместе, одним шагом
+    (раньше счётчик штук списывался, даже если потом не проходил объём, а два быстрых сообщения
+    могли оба проскочить лимит). Возвращает (можно ли, текст отказа для Markdown, счётчики после).
+    kind: "text" (amount — символы) или "audio" (amount — секунды). Премиум — безлимит по дню.
+    """
+    if premium is None:
+        premium = is_premium(user_id)
+    if kind == "text":
+        if amount > (2000 if premium else TEXT_MAX_LEN_PER_MSG):
+            return False, ("⚠️ Очень длинное сообщение. Разбей, пожалуйста." if premium else TEXT_TOO_LONG_MSG), get_usage(user_id)
+        checks = {"text": (1, FREE_LIMIT_TEXT), "text_chars": (amount, TEXT_MAX_LEN_PER_DAY)}
+    elif kind == "audio":
+        if amount > (600 if premium else AUDIO_MAX_SEC_PER_MSG):
+            return False, ("⚠️ Очень длинное аудио. Сделай короче, пожалуйста." if premium else AUDIO_TOO_LONG_MSG), get_usage(user_id)
+        checks = {"audio": (1, FREE_LIMIT_AUDIO), "audio_secs": (amount, AUDIO_MAX_SEC_PER_DAY)}
+    else:
+        return False, "", get_usage(user_id)
+
+    if premium:
+        return True, "", get_usage(user_id)
+
+    ok, field, counters = usage_ledger.add_all(user_id, checks)
+    if ok:
+        return True, "", counters
+    if field in ("text", "audio"):
+        return False, limit_msg(field), counters
+    if field == "text_chars":
+        left = max(0, TEXT_MAX_LEN_PER_DAY - counters["text_chars"])
+        return False, f"🚫 Лимит символов на сегодня исчерпан. Осталось: {left}/{TEXT_MAX_LEN_PER_DAY}. Завтра обнулится.", counters
+    left = max(0, AUDIO_MAX_SEC_PER_DAY - counters["audio_secs"])
+    return False, f"🚫 Лимит длительности аудио исчерпан. Осталось: {left} сек. из {AUDIO_MAX_SEC_PER_DAY}. Завтра обнулится.", counters
+
+def refund_audio_secs(user_id: int, secs: int):
+    """Вернуть в дневной лимит секунды, которые не ушли в распознавание (например, срезанная тишина)."""
+    if secs > 0:
+        usage_ledger.add(user_id, "audio_secs", -secs)
 
 def limit_msg(kind):
     if kind == "text":
@@ -421,40 +895,729 @@ def limit_msg(kind):
     else:
         return "🚫 Лимит *аудио* переводов (3) исчерпан. 🔄 Сброс в полночь. Нужен безлимит? /premium"
 
+# ===== Локальный кэш: LRU в памяти + SQLite на диске =====
+import sqlite3
+from collections import OrderedDict
+from dedupe_phrases import norm_he
+from idiom_matcher import IdiomMatcher
+
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH") or os.path.join(BASE_DIR, "cache.sqlite3")
+_CACHE_DB = None
+_CACHE_DB_LOCK = threading.Lock()
+_CACHES = []  # все созданные LocalCache — для /cache_stats
+
+def _cache_db():
+    """Одно соединение SQLite на процесс (потоки telebot ходят через общий lock)."""
+    global _CACHE_DB
+    if _CACHE_DB is None:
+        conn = sqlite3.connect(CACHE_DB_PATH, check_same_thread=False, timeout=5)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            " ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL, used_at REAL NOT NULL,"
+            " PRIMARY KEY (ns, key))"
+        )
+        conn.commit()
+        _CACHE_DB = conn
+    return _CACHE_DB
+
+def norm_text_key(s: str) -> str:
+    """Ключ для кэшей: без никуда/кавычек (как в dedupe_phrases) и с одинарными пробелами."""
+    return " ".join(norm_he(s).split())
+
+class LocalCache:
+    """
+    Двухуровневый кэш с TTL на каждую запись:
+    1) OrderedDict-LRU в памяти (микросекунды),
+    2) таблица kv в SQLite — переживает рестарт, тоже с LRU-обрезкой по used_at.
+    Если диск недоступен — работаем только в памяти.
+    """
+
+    def __init__(self, ns: str, max_items: int = 2000, max_disk_items: int = 50000, ttl: float = 7 * 24 * 3600):
+        self.ns = ns
+        self.max_items = max_items
+        self.max_disk_items = max_disk_items
+        self.ttl = ttl
+        self._mem = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._sets_since_trim = 0
+        self.stats = {"hits_mem": 0, "hits_disk": 0, "misses": 0, "evictions": 0, "expired": 0, "sets": 0}
+        self.disk = True
+        try:
+            _cache_db()
+        except Exception as e:
+            print(f"[cache:{ns}] диск выключен: {e}")
+            self.disk = False
+        _CACHES.append(self)
+
+    def _mem_put(self, key, expires_at, value):
+        self._mem[key] = (expires_at, value)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def get(self, key: str):
+        return self.get_first([key])
+
+    def get_first(self, keys, count: bool = True):
+        """
+        Одна логическая выборка по нескольким ключам-вариантам одного значения (например, перевод
+        разными движками): первое живое значение в порядке keys. Диск — одним SELECT.
+        В статистику идёт один hit или miss (и не больше одного expired) на вызов, а не на каждый ключ.
+        """
+        now = time.time()
+        expired = False
+        with self._lock:
+            for key in keys:
+                item = self._mem.get(key)
+                if item is None:
+                    continue
+                if item[0] > now:
+                    self._mem.move_to_end(key)
+                    if count:
+                        self.stats["hits_mem"] += 1
+                        self.stats["expired"] += int(expired)
+                    return item[1]
+                del self._mem[key]
+                expired = True
+
+        if self.disk:
+            try:
+                marks = ",".join("?" * len(keys))
+                with _CACHE_DB_LOCK:
+                    conn = _cache_db()
+                    rows = conn.execute(
+                        f"SELECT key, value, expires_at FROM kv WHERE ns=? AND key IN ({marks})", (self.ns, *keys)
+                    ).fetchall()
+                    live = {k: (v, exp) for k, v, exp in rows if exp > now}
+                    dead = [k for k, _, exp in rows if exp <= now]
+                    best = next((k for k in keys if k in live), None)
+                    if best is not None:
+                        conn.execute("UPDATE kv SET used_at=? WHERE ns=? AND key=?", (now, self.ns, best))
+                    if dead:
+                        conn.execute(f"DELETE FROM kv WHERE ns=? AND key IN ({','.join('?' * len(dead))})",
+                                     (self.ns, *dead))
+                    if best is not None or dead:
+                        conn.commit()
+                expired = expired or bool(dead)
+                if best is not None:
+                    value = json.loads(live[best][0])
+                    with self._lock:
+                        self._mem_put(best, live[best][1], value)
+                        if count:
+                            self.stats["hits_disk"] += 1
+                            self.stats["expired"] += int(expired)
+                    return value
+            except Exception as e:
+                print(f"[cache:{self.ns}] read err: {e}")
+
+        if count:
+            with self._lock:
+                self.stats["misses"] += 1
+                self.stats["expired"] += int(expired)
+        return None
+
+    def set(self, key: str, value, ttl: float = None):
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._mem_put(key, expires_at, value)
+            self.stats["sets"] += 1
+            self._sets_since_trim += 1
+            need_trim = self._sets_since_trim >= 200
+            if need_trim:
+                self._sets_since_trim = 0
+
+        if not self.disk:
+            return
+        try:
+            with _CACHE_DB_LOCK:
+                conn = _cache_db()
+                conn.execute(
+                    "INSERT OR REPLACE INTO kv (ns, key, value, expires_at, used_at) VALUES (?, ?, ?, ?, ?)",
+                    (self.ns, key, json.dumps(value, ensure_ascii=False), expires_at, now),
+                )
+                conn.commit()
+            if need_trim:
+                self._trim_disk()
+        except Exception as e:
+            print(f"[cache:{self.ns}] write err: {e}")
+
+    def delete(self, key: str):
+        with self._lock:
+            self._mem.pop(key, None)
+        if self.disk:
+            try:
+                with _CACHE_DB_LOCK:
+                    conn = _cache_db()
+                    conn.execute("DELETE FROM kv WHERE ns=? AND key=?", (self.ns, key))
+                    conn.commit()
+            except Exception as e:
+                print(f"[cache:{self.ns}] delete err: {e}")
+
+    def _trim_disk(self):
+        """Чистим протухшее и всё, что сверх max_disk_items (самые давно использованные)."""
+        with _CACHE_DB_LOCK:
+            conn = _cache_db()
+            conn.execute("DELETE FROM kv WHERE ns=? AND expires_at<=?", (self.ns, time.time()))
+            (count,) = conn.execute("SELECT COUNT(*) FROM kv WHERE ns=?", (self.ns,)).fetchone()
+            extra = count - self.max_disk_items
+            if extra > 0:
+                conn.execute(
+                    "DELETE FROM kv WHERE ns=? AND key IN ("
+                    " SELECT key FROM kv WHERE ns=? ORDER BY used_at ASC LIMIT ?)",
+                    (self.ns, self.ns, extra),
+                )
+            conn.commit()
+        if extra > 0:
+            with self._lock:
+                self.stats["evictions"] += extra
+
+    def hit_rate(self) -> float:
+        s = self.stats
+        total = s["hits_mem"] + s["hits_disk"] + s["misses"]
+        return (s["hits_mem"] + s["hits_disk"]) / total if total else 0.0
+
+    def stats_line(self) -> str:
+        s = self.stats
+        return (
+            f"{self.ns}: hit {self.hit_rate():.0%} (mem {s['hits_mem']}, disk {s['hits_disk']}, miss {s['misses']}), "
+            f"evict {s['evictions']}, expired {s['expired']}, в памяти {len(self._mem)}/{self.max_items}"
+        )
+
+# ===== Single-flight: одинаковые одновременные запросы делят один вызов =====
+class _Flight:
+    __slots__ = ("event", "result", "error", "waiters")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    """
+    Пока по ключу идёт вызов, остальные потоки с тем же ключом не зовут upstream,
+    а ждут и получают тот же результат (или ту же ошибку).
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.stats = {"calls": 0, "coalesced": 0}
+        _FLIGHTS.append(self)
+
+    def do(self, key: str, fn, *args, **kwargs):
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+                self.stats["calls"] += 1
+            else:
+                flight.waiters += 1
+                self.stats["coalesced"] += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn(*args, **kwargs)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.event.set()
+
+    def do_future(self, key: str, start):
+        """
+        Неблокирующий вариант: start() запускает работу и возвращает Future.
+        Возвращает (future, leader) — ждущие получают тот же future и вешают на него колбэки.
+        """
+        with self._lock:
+            fut = self._inflight.get(key)
+            if fut is not None:
+                self.stats["coalesced"] += 1
+                return fut, False
+            fut = start()
+            self._inflight[key] = fut
+            self.stats["calls"] += 1
+
+        def _done(_):
+            with self._lock:
+                if self._inflight.get(key) is fut:
+                    del self._inflight[key]
+
+        fut.add_done_callback(_done)
+        return fut, True
+
+    def stats_line(self) -> str:
+        s = self.stats
+        total = s["calls"] + s["coalesced"]
+        share = s["coalesced"] / total if total else 0.0
+        return f"{self.name}: upstream-вызовов {s['calls']}, склеено {s['coalesced']} ({share:.0%}), сейчас в полёте {len(self._inflight)}"
+
+_FLIGHTS = []  # для /cache_stats
+
 # ===== Переводчики =====
+import requests
+from requests.adapters import HTTPAdapter
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from deep_translator import GoogleTranslator, MyMemoryTranslator
+import deep_translator.google as _dt_google
+import deep_translator.mymemory as _dt_mymemory
+
+TRANSLATE_ERROR = "⚠️ Ошибка перевода"
+TRANSLATE_CACHE_TTL = int(os.getenv("TRANSLATE_CACHE_TTL", str(30 * 24 * 3600)))
+TRANSLATE_HTTP_TIMEOUT = float(os.getenv("TRANSLATE_HTTP_TIMEOUT", "8"))
+TRANSLATE_POOL_SIZE = int(os.getenv("TRANSLATE_POOL_SIZE", "8"))  # макс. соединений и idle-клиентов на движок
+# hedged-режим: если основной движок не ответил за pXX своей латентности — параллельно зовём второй
+TRANSLATE_HEDGE = os.getenv("TRANSLATE_HEDGE", "1") == "1"
+TRANSLATE_HEDGE_PCT = float(os.getenv("TRANSLATE_HEDGE_PCT", "90"))
+TRANSLATE_HEDGE_MIN_MS = float(os.getenv("TRANSLATE_HEDGE_MIN_MS", "250"))
+TRANSLATE_HEDGE_MAX_MS = float(os.getenv("TRANSLATE_HEDGE_MAX_MS", "3000"))
+TRANSLATE_HEDGE_DEFAULT_MS = 1200  # пока мало замеров
+translate_cache = LocalCache("translate", max_items=5000, ttl=TRANSLATE_CACHE_TTL)
+
+def _percentile(values, pct: float) -> float:
+    vals = sorted(values)
+    if not vals:
+        return 0.0
+    k = min(len(vals) - 1, max(0, int(round(pct / 100.0 * (len(vals) - 1)))))
+    return vals[k]
+
+class _PooledRequests:
+    """
+    deep-translator зовёт голый requests.get() — без keep-alive и без таймаута.
+    Подменяем модуль requests внутри него: get() идёт через общую сессию.
+    """
 
-def translate_text(text: str) -> str:
-    """Стабильный перевод: сначала deep-translator, при ошибке — MyMemory."""
+    def __init__(self, session: requests.Session, timeout: float):
+        self._session = session
+        self._timeout = timeout
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault("timeout", self._timeout)
+        return self._session.get(url, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+def _make_http_session(pool_size: int) -> requests.Session:
+    s = requests.Session()
+    # pool_block=True — не больше pool_size одновременных соединений к хосту
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, pool_block=True, max_retries=0)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+class TranslatorPool:
+    """
+    Пул переиспользуемых клиентов по ключу (engine, source, target).
+    Объекты deep-translator не потокобезопасны (меняют свои _url_params в translate),
+    поэтому клиент берётся из пула на время вызова и потом возвращается.
+    HTTP-сессии с keep-alive — общие на движок.
+    """
+
+    ENGINES = {"google": (GoogleTranslator, _dt_google), "mymemory": (MyMemoryTranslator, _dt_mymemory)}
+
+    def __init__(self, pool_size: int = TRANSLATE_POOL_SIZE, timeout: float = TRANSLATE_HTTP_TIMEOUT):
+        self.pool_size = pool_size
+        self._idle = {}  # (engine, src, target) -> [translator, ...]
+        self._lock = threading.Lock()
+        self.timing = {name: {"calls": 0, "errors": 0, "created": 0, "total_ms": 0.0, "recent": deque(maxlen=200)}
+                       for name in self.ENGINES}
+        for name, (_, module) in self.ENGINES.items():
+            try:
+                module.requests = _PooledRequests(_make_http_session(pool_size), timeout)
+            except Exception as e:
+                print(f"[tr_pool] keep-alive для {name} не включён: {e}")
+
+    def _checkout(self, engine: str, src: str, target: str):
+        key = (engine, src, target)
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop()
+            self.timing[engine]["created"] += 1
+        cls = self.ENGINES[engine][0]
+        return cls(source=src, target=target)
+
+    def _checkin(self, engine: str, src: str, target: str, tr):
+        with self._lock:
+            idle = self._idle.setdefault((engine, src, target), [])
+            if len(idle) < self.pool_size:
+                idle.append(tr)
+
+    def translate(self, engine: str, text: str, src: str, target: str = "ru") -> str:
+        tr = self._checkout(engine, src, target)
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            res = tr.translate(text)
+            ok = True
+            return res
+        finally:
+            ms = (time.perf_counter() - t0) * 1000
+            with self._lock:
+                t = self.timing[engine]
+                t["calls"] += 1
+                t["total_ms"] += ms
+                t["recent"].append(ms)
+                if not ok:
+                    t["errors"] += 1
+            self._checkin(engine, src, target, tr)
+
+    def stats_lines(self) -> list:
+        lines = []
+        with self._lock:
+            for name, t in self.timing.items():
+                avg = t["total_ms"] / t["calls"] if t["calls"] else 0.0
+                recent = list(t["recent"])
+                lines.append(
+                    f"{name}: вызовов {t['calls']}, ошибок {t['errors']}, клиентов создано {t['created']}, "
+                    f"avg {avg:.0f} мс, p50 {_percentile(recent, 50):.0f} мс, p90 {_percentile(recent, 90):.0f} мс"
+                )
+        return lines
+
+translator_pool = TranslatorPool()
+_TR_EXECUTOR = ThreadPoolExecutor(max_workers=TRANSLATE_POOL_SIZE * 2, thread_name_prefix="tr")
+hedge_stats = {"calls": 0, "hedged": 0, "primary_won": 0, "secondary_won": 0, "failed": 0}
+
+# ---- Circuit breaker на каждый движок ----
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "40"))            # сколько последних вызовов смотрим
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "8"))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))  # доля ошибок → open
+BREAKER_SLOW_MS = float(os.getenv("BREAKER_SLOW_MS", "5000"))
+BREAKER_SLOW_RATE = float(os.getenv("BREAKER_SLOW_RATE", "0.6"))    # доля медленных ответов → open
+BREAKER_COOLDOWN_S = float(os.getenv("BREAKER_COOLDOWN_S", "60"))
+BREAKER_MAX_COOLDOWN_S = 30 * 60
+BREAKER_PROBE_TEXT = "שלום"
+
+class EngineBreaker:
+    """
+    closed → трафик идёт; open → движок пропускаем до конца cooldown;
+    half_open → пользовательский трафик всё ещё не пускаем, а в фоне шлём пробный перевод.
+    Удачная проба закрывает breaker, неудачная — снова open с удвоенным cooldown.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, engine: str):
+        self.engine = engine
+        self.state = self.CLOSED
+        self.window = deque(maxlen=BREAKER_WINDOW)  # (ok, ms)
+        self.cooldown = BREAKER_COOLDOWN_S
+        self.opened_at = 0.0
+        self.trips = 0
+        self._lock = threading.Lock()
+
+    def _rates(self):
+        n = len(self.window)
+        if not n:
+            return 0.0, 0.0
+        errors = sum(1 for ok, _ in self.window if not ok)
+        slow = sum(1 for ok, ms in self.window if ok and ms > BREAKER_SLOW_MS)
+        return errors / n, slow / n
+
+    def allow(self) -> bool:
+        probe = False
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+                probe = True
+        if probe:
+            threading.Thread(target=self._probe, daemon=True).start()
+        return False
+
+    def record(self, ok: bool, ms: float):
+        with self._lock:
+            if self.state != self.CLOSED:
+                return
+            self.window.append((ok, ms))
+            if len(self.window) < BREAKER_MIN_CALLS:
+                return
+            err_rate, slow_rate = self._rates()
+            if err_rate >= BREAKER_ERROR_RATE or slow_rate >= BREAKER_SLOW_RATE:
+                self._trip(f"errors={err_rate:.0%} slow={slow_rate:.0%}")
+
+    def _trip(self, why: str):
+        self.state = self.OPEN
+        self.opened_at = time.time()
+        self.trips += 1
+        print(f"[breaker] {self.engine} → open на {self.cooldown:.0f}с ({why})")
+
+    def _probe(self):
+        t0 = time.perf_counter()
+        try:
+            translator_pool.translate(self.engine, BREAKER_PROBE_TEXT, "iw")
+            ok = (time.perf_counter() - t0) * 1000 <= BREAKER_SLOW_MS
+        except Exception as e:
+            print(f"[breaker] {self.engine} probe error: {e}")
+            ok = False
+        with self._lock:
+            if ok:
+                self.state = self.CLOSED
+                self.window.clear()
+                self.cooldown = BREAKER_COOLDOWN_S
+                print(f"[breaker] {self.engine} → closed (проба прошла)")
+            else:
+                self.cooldown = min(self.cooldown * 2, BREAKER_MAX_COOLDOWN_S)
+                self._trip("проба не прошла")
+
+    def score(self) -> float:
+        """Чем меньше — тем лучше: медиана задержки с штрафом за ошибки; open/half_open — бесконечность."""
+        with self._lock:
+            if self.state != self.CLOSED:
+                return float("inf")
+            err_rate, _ = self._rates()
+            oks = [ms for ok, ms in self.window if ok]
+        p50 = _percentile(oks, 50) if oks else TRANSLATE_HEDGE_DEFAULT_MS
+        return p50 * (1 + 4 * err_rate)
+
+    def stats_line(self) -> str:
+        with self._lock:
+            err_rate, slow_rate = self._rates()
+            state, n, trips = self.state, len(self.window), self.trips
+        return (f"{self.engine}: {state}, ошибок {err_rate:.0%}, медленных {slow_rate:.0%} "
+                f"(окно {n}), срабатываний {trips}, score {self.score():.0f}")
+
+engine_breakers = {name: EngineBreaker(name) for name in TranslatorPool.ENGINES}
+
+def _route_engines(preferred: str = None) -> list:
+    """
+    Порядок движков: сначала живые (breaker пускает) по score, потом остальные.
+    preferred — движок, который явно попросили (кнопка «Новый перевод»): он первый, если жив.
+    """
+    alive = [e for e in engine_breakers if engine_breakers[e].allow()]
+    alive.sort(key=lambda e: (e != preferred, engine_breakers[e].score()))
+    dead = [e for e in engine_breakers if e not in alive]
+    return alive + dead
+
+def _tr_cache_key(text: str, engine: str) -> str:
+    return f"{engine}|{norm_text_key(text)}"
+
+def _tr_cache_get(text: str, *engines: str, count: bool = True):
+    """Перевод из кэша по первому из engines, у которого он есть; одна выборка на вызов."""
+    return translate_cache.get_first([_tr_cache_key(text, e) for e in engines], count=count)
+
+def _tr_cache_put(text: str, engine: str, result: str) -> str:
+    # ошибки и пустые ответы не кэшируем
+    if result and result != TRANSLATE_ERROR:
+        translate_cache.set(_tr_cache_key(text, engine), result)
+    return result
+
+def _engine_translate(engine: str, text: str) -> str:
+    """Один вызов движка через пул клиентов; исход пишем в breaker, удачный результат — в кэш."""
     src = "iw" if HEB_RE.search(text) else "auto"
+    t0 = time.perf_counter()
+    try:
+        res = translator_pool.translate(engine, text, src)
+    except Exception:
+        engine_breakers[engine].record(False, (time.perf_counter() - t0) * 1000)
+        raise
+    engine_breakers[engine].record(True, (time.perf_counter() - t0) * 1000)
+    return _tr_cache_put(text, engine, res)
+
+def _hedge_deadline_s(engine: str) -> float:
+    """Дедлайн хеджа = pXX недавних задержек движка (адаптируется сам), с ограничениями снизу/сверху."""
+    with translator_pool._lock:
+        recent = list(translator_pool.timing[engine]["recent"])
+    if len(recent) < 20:
+        ms = TRANSLATE_HEDGE_DEFAULT_MS
+    else:
+        ms = _percentile(recent, TRANSLATE_HEDGE_PCT)
+    return min(TRANSLATE_HEDGE_MAX_MS, max(TRANSLATE_HEDGE_MIN_MS, ms)) / 1000.0
+
+def _translate_hedged(text: str, primary: str, secondary: str) -> tuple[str, str]:
+    """
+    Запускаем основной движок; если он не успел к дедлайну — параллельно запускаем второй
+    и берём первый удачный ответ. Проигравший отменяется (если ещё не стартовал)
+    или просто отбрасывается — его результат всё равно осядет в кэше.
+    """
+    hedge_stats["calls"] += 1
+    first = _TR_EXECUTOR.submit(_engine_translate, primary, text)
+    futs = {first: primary}
+    last_err = None
+    if secondary is None:
+        # второй движок выключен breaker'ом — хеджировать не на что
+        return first.result(), primary
+    done, _ = wait([first], timeout=_hedge_deadline_s(primary))
+    if not done:
+        hedge_stats["hedged"] += 1
+    elif first.exception() is None:
+        hedge_stats["primary_won"] += 1
+        return first.result(), primary
+    else:
+        # основной уже упал — обычный фолбэк, без гонки
+        last_err = first.exception()
+        print(f"[translate] {primary} error: {last_err}")
+        futs.pop(first)
+    futs[_TR_EXECUTOR.submit(_engine_translate, secondary, text)] = secondary
+
+    pending = set(futs)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for f in done:
+            if f.exception() is None:
+                for other in pending:
+                    other.cancel()
+                engine = futs[f]
+                hedge_stats["primary_won" if engine == primary else "secondary_won"] += 1
+                return f.result(), engine
+            last_err = f.exception()
+            print(f"[translate] {futs[f]} error: {last_err}")
+    hedge_stats["failed"] += 1
+    raise last_err or RuntimeError("нет ответа от движков")
+
+def _translate_single(text: str, check_cache: bool = True) -> str:
+    """Перевод одного куска: кэш (если его уже не смотрели) → лучший живой движок (с хеджем на второй) → фолбэк."""
+    if check_cache:
+        hit = _tr_cache_get(text, "google", "mymemory")
+        if hit is not None:
+            return hit
+
+    order = _route_engines()
+    primary = order[0]
+    secondary = order[1] if len(order) > 1 and engine_breakers[order[1]].state == EngineBreaker.CLOSED else None
+
+    if TRANSLATE_HEDGE:
+        try:
+            return _translate_hedged(text, primary, secondary)[0]
+        except Exception as e:
+            print(f"[translate_text] движки упали: {e}")
+            return TRANSLATE_ERROR
+
     try:
-        return GoogleTranslator(source=src, target="ru").translate(text)
+        return _engine_translate(primary, text)
     except Exception as e1:
-        print(f"[translate_text] deep-translator error: {e1}")
+        print(f"[translate_text] {primary} error: {e1}")
+        if secondary is None:
+            return TRANSLATE_ERROR
         try:
-            return MyMemoryTranslator(source=src, target="ru").translate(text)
+            return _engine_translate(secondary, text)
         except Exception as e2:
-            print(f"[translate_text] MyMemory error: {e2}")
-            return "⚠️ Ошибка перевода"
+            print(f"[translate_text] {secondary} error: {e2}")
+            return TRANSLATE_ERROR
+
+# ---- Память переводов по предложениям ----
+TM_TTL = int(os.getenv("TM_TTL", str(90 * 24 * 3600)))
+translation_memory = LocalCache("tm", max_items=10000, max_disk_items=200000, ttl=TM_TTL)
+_SEG_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("TM_CONCURRENCY", "4")), thread_name_prefix="seg")
+tm_stats = {"texts": 0, "segments": 0, "reused": 0}
+
+# режем после . ! ? … (и по переводам строк), разделители сохраняем для обратной склейки
+_SENT_SPLIT_RE = re.compile(r"((?<=[.!?…])\s+|\s*\n+\s*)")
+
+def _split_sentences(text: str) -> list:
+    """[сегмент, разделитель, сегмент, ...] — чётные индексы это предложения."""
+    return _SENT_SPLIT_RE.split(text)
+
+def _translate_segments(parts: list) -> tuple[str, bool]:
+    """
+    Каждое предложение ищем в памяти переводов; переводим (параллельно) только недостающие.
+    Если какой-то сегмент не перевёлся — оставляем его как есть. Возвращает (текст, всё_ли_перевелось).
+    """
+    out = list(parts)
+    missing = {}
+    segments = 0
+    tm_stats["texts"] += 1
+    for i in range(0, len(parts), 2):
+        seg = parts[i].strip()
+        if not seg or not any(ch.isalpha() for ch in seg):
+            continue
+        segments += 1
+        tm_stats["segments"] += 1
+        hit = translation_memory.get(norm_text_key(seg))
+        if hit is not None:
+            tm_stats["reused"] += 1
+            out[i] = hit
+        else:
+            missing[i] = seg
+
+    futs = {i: _SEG_EXECUTOR.submit(_translate_single, seg) for i, seg in missing.items()}
+    failed = 0
+    for i, fut in futs.items():
+        try:
+            res = fut.result()
+        except Exception as e:
+            print(f"[tm] segment error: {e}")
+            res = TRANSLATE_ERROR
+        if res == TRANSLATE_ERROR:
+            failed += 1
+            continue
+        translation_memory.set(norm_text_key(missing[i]), res)
+        out[i] = res
+
+    if failed and failed == segments:
+        return TRANSLATE_ERROR, False
+    return "".join(out), failed == 0
+
+translate_flight = SingleFlight("translate")
+
+def translate_text(text: str) -> str:
+    """
+    Перевод с памятью по предложениям: длинное сообщение режем на предложения,
+    повторно используем уже переведённые и переводим только новые.
+    Одинаковые тексты, пришедшие одновременно, переводятся один раз.
+    """
+    hit = _tr_cache_get(text, "google", "mymemory", "segments")
+    if hit is not None:
+        return hit
+    return translate_flight.do(norm_text_key(text), _translate_uncached, text)
+
+def _translate_uncached(text: str) -> str:
+    parts = _split_sentences(text)
+    if sum(1 for p in parts[::2] if p.strip()) < 2:
+        return _translate_single(text, check_cache=False)  # translate_text кэш уже проверил
+
+    res, complete = _translate_segments(parts)
+    if complete:
+        # сборка из памяти и разных движков — не ответ google: свой ключ, его читает только translate_text
+        _tr_cache_put(text, "segments", res)
+    return res
 
 def translate_with_engine(text: str, engine: str) -> tuple[str, str]:
-    """Перевод строго выбранным движком. Возвращает (перевод, использованный_движок)."""
-    src = "iw" if HEB_RE.search(text) else "auto"
+    """
+    Перевод выбранным движком. Возвращает (перевод, использованный_движок).
+    Если у выбранного движка открыт breaker — сразу идём в другой, не тратя таймаут.
+    """
+    engine = "mymemory" if engine == "mymemory" else "google"
+    hit = _tr_cache_get(text, engine)
+    if hit is not None:
+        return hit, engine
+
+    # дальше — пробы того же перевода под другим движком: в статистику кэша они не идут
+    order = _route_engines(preferred=engine)
+    first, other = order[0], order[1]
+    if first != engine:
+        hit = _tr_cache_get(text, first, count=False)
+        if hit is not None:
+            return hit, first
+
     try:
-        if engine == "mymemory":
-            return MyMemoryTranslator(source=src, target="ru").translate(text), "mymemory"
-        else:
-            return GoogleTranslator(source=src, target="ru").translate(text), "google"
+        return _engine_translate(first, text), first
     except Exception as e:
-        other = "google" if engine == "mymemory" else "mymemory"
+        hit = _tr_cache_get(text, other, count=False)
+        if hit is not None:
+            return hit, other
         try:
-            if other == "mymemory":
-                return MyMemoryTranslator(source=src, target="ru").translate(text), "mymemory"
-            else:
-                return GoogleTranslator(source=src, target="ru").translate(text), "google"
+            return _engine_translate(other, text), other
         except Exception as e2:
             print(f"[translate_with_engine] оба упали: {e} / {e2}")
-            return "⚠️ Ошибка перевода", engine
+            return TRANSLATE_ERROR, engine
 
 # === Фильтр «осмысленного» текста ===
 HEB = r"\u0590-\u05FF"
@@ -500,14 +1663,13 @@ IDIOMS = {
     "מה נסגר איתך": "«Что с тобой происходит?» — разговорное.",
 }
 
+# словарь сленга можно расширять файлом (перечитывается на лету), IDIOMS — встроенная база
+IDIOMS_FILE = os.getenv("IDIOMS_FILE") or os.path.join(BASE_DIR, "idioms.json")
+idiom_matcher = IdiomMatcher(IDIOMS_FILE, IDIOMS)
+
 def explain_local(he_text: str) -> str:
     tr = translate_text(he_text)
-    hits = []
-    low = he_text.replace("׳", "").replace("'", "")
-    for k, note in IDIOMS.items():
-        kk = k.replace("׳", "").replace("'", "")
-        if kk in low:
-           hits.append(f"• *{k}* — {note}")
+    hits = [f"• *{k}* — {note}" for k, note in idiom_matcher.find(he_text)]
 
     note_block = "\n".join(hits) if hits else "Сленг/идиом не найдено."
     
@@ -517,86 +1679,597 @@ def explain_local(he_text: str) -> str:
         f"Грамматика: разговорная речь; для точного морфоразбора нужен онлайн-режим."
     )
 
+# ===== OpenAI: отдельный пул потоков, ретраи без sleep в обработчиках =====
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "4"))
+_OPENAI_POOL = ThreadPoolExecutor(max_workers=OPENAI_MAX_CONCURRENCY, thread_name_prefix="openai")
+# целиком аудио-задачи (скачать → перекодировать → распознать → перевести) — тоже не в потоках telebot;
+# они в основном ждут сеть и OpenAI, а CPU (ffmpeg) ограничивает transcode_pool
+_AUDIO_JOBS = ThreadPoolExecutor(max_workers=int(os.getenv("AUDIO_JOBS", "6")), thread_name_prefix="audio")
+# колбэки готовых Future (отправка ответа в Telegram, офлайн-фолбэк) — не в потоках OpenAI:
+# done-callback выполняется в потоке, который выставил результат, и занимал бы слот планировщика
+_OPENAI_CALLBACKS = ThreadPoolExecutor(max_workers=2, thread_name_prefix="openai-cb")
+openai_stats = {"submitted": 0, "retries": 0, "failed": 0, "inflight": 0, "rate_limited": 0}
+
+def off_worker(cb):
+    """Обёртка для add_done_callback: сам колбэк уходит в _OPENAI_CALLBACKS."""
+    return lambda f: _OPENAI_CALLBACKS.submit(cb, f)
+
+# ---- Планировщик: токен-бакеты RPM/TPM, приоритетные полосы, честность между пользователями ----
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", "300"))
+OPENAI_TPM = float(os.getenv("OPENAI_TPM", "60000"))
+OPENAI_RATE_LIMIT_RETRIES = int(os.getenv("OPENAI_RATE_LIMIT_RETRIES", "6"))
+OPENAI_429_COOLDOWN_S = 5.0
+
+LANE_PREMIUM, LANE_FREE, LANE_BATCH = 0, 1, 2  # интерактив премиума → интерактив бесплатных → фоновые задачи
+LANE_NAMES = {LANE_PREMIUM: "premium", LANE_FREE: "free", LANE_BATCH: "batch"}
+
+class TokenBucket:
+    """Классический токен-бакет: capacity токенов, пополняется со скоростью rate_per_min."""
+
+    def __init__(self, rate_per_min: float, capacity: float = None):
+        self.rate = rate_per_min / 60.0
+        self.capacity = capacity or rate_per_min
+        self.tokens = self.capacity
+        self.updated = time.time()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, n: float, now: float) -> float:
+        self._refill(now)
+        n = min(n, self.capacity)
+        return 0.0 if self.tokens >= n else (n - self.tokens) / self.rate
+
+    def take(self, n: float):
+        self.tokens -= min(n, self.capacity)
+
+class OpenAIScheduler:
+    """
+    Очередь запросов к OpenAI вместо мгновенных 429: задача ждёт, пока есть RPM/TPM и свободный поток.
+    Внутри полосы пользователи обслуживаются по кругу — один пользователь не забьёт очередь.
+    """
+
+    def __init__(self, pool: ThreadPoolExecutor, max_running: int):
+        self.pool = pool
+        self.max_running = max_running
+        self.rpm = TokenBucket(OPENAI_RPM)
+        self.tpm = TokenBucket(OPENAI_TPM)
+        self.running = 0
+        self.cooldown_until = 0.0
+        self._lanes = {lane: OrderedDict() for lane in LANE_NAMES}  # lane -> {user_id: deque(jobs)}
+        self._cond = threading.Condition()
+        self.waits_ms = {lane: deque(maxlen=500) for lane in LANE_NAMES}
+        threading.Thread(target=self._loop, daemon=True, name="openai-scheduler").start()
+
+    def submit(self, run, lane: int = LANE_FREE, user_id=None, est_tokens: int = 0):
+        job = {"run": run, "lane": lane, "tokens": est_tokens, "enq": time.time()}
+        with self._cond:
+            self._lanes[lane].setdefault(user_id, deque()).append(job)
+            self._cond.notify()
+
+    def penalize(self):
+        """Пришёл 429 — на несколько секунд перестаём выпускать новые запросы."""
+        with self._cond:
+            self.cooldown_until = max(self.cooldown_until, time.time() + OPENAI_429_COOLDOWN_S)
+            self.rpm.tokens = 0
+
+    def depth(self) -> dict:
+        with self._cond:
+            return {LANE_NAMES[l]: sum(len(q) for q in users.values()) for l, users in self._lanes.items()}
+
+    def _peek(self):
+        for lane in sorted(self._lanes):
+            users = self._lanes[lane]
+            if users:
+                uid = next(iter(users))
+                return lane, uid, users[uid][0]
+        return None
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                nxt = self._peek()
+                if nxt is None or self.running >= self.max_running:
+                    self._cond.wait(1.0)
+                    continue
+                lane, uid, job = nxt
+                now = time.time()
+                pause = max(self.cooldown_until - now, self.rpm.wait_time(1, now), self.tpm.wait_time(job["tokens"], now))
+                if pause > 0:
+                    self._cond.wait(min(pause, 1.0))
+                    continue
+                users = self._lanes[lane]
+                users[uid].popleft()
+                if users[uid]:
+                    users.move_to_end(uid)  # round-robin: у пользователя есть ещё — в конец круга
+                else:
+                    del users[uid]
+                self.rpm.take(1)
+                self.tpm.take(job["tokens"])
+                self.running += 1
+                self.waits_ms[lane].append((now - job["enq"]) * 1000)
+            self.pool.submit(self._run, job)
+
+    def _run(self, job):
+        try:
+            job["run"]()
+        finally:
+            with self._cond:
+                self.running -= 1
+                self._cond.notify()
+
+    def stats_lines(self) -> list:
+        depth = self.depth()
+        lines = ["Очередь: " + ", ".join(f"{k} {v}" for k, v in depth.items()) + f"; выполняется {self.running}/{self.max_running}"]
+        for lane, name in LANE_NAMES.items():
+            w = list(self.waits_ms[lane])
+            if w:
+                lines.append(f"Ожидание {name}: p50 {_percentile(w, 50):.0f} мс, p90 {_percentile(w, 90):.0f} мс, max {max(w):.0f} мс")
+        lines.append(f"Бакеты: RPM {self.rpm.tokens:.0f}/{self.rpm.capacity:.0f}, TPM {self.tpm.tokens:.0f}/{self.tpm.capacity:.0f}")
+        return lines
+
+openai_scheduler = OpenAIScheduler(_OPENAI_POOL, OPENAI_MAX_CONCURRENCY)
+
+def user_lane(user_id) -> int:
+    try:
+        return LANE_PREMIUM if user_id and is_premium(int(user_id)) else LANE_FREE
+    except Exception:
+        return LANE_FREE
+
+def openai_submit(fn, *args, max_retries: int = 3, tag: str = "openai",
+                  user_id=None, lane: int = LANE_FREE, est_tokens: int = 0, **kwargs) -> Future:
+    """
+    Ставит fn(*args, **kwargs) в очередь планировщика OpenAI (RPM/TPM, приоритет полосы, честность по user_id).
+    Ретраи с экспоненциальной паузой планируются таймером — ни один поток не спит.
+    Auth/BadRequest не ретраим (это подклассы APIStatusError, поэтому ловим их первыми);
+    на 429 притормаживаем весь планировщик и даём больше попыток — запрос ждёт, а не падает.
+    """
+    outer = Future()
+    openai_stats["submitted"] += 1
+
+    def _schedule(n: int, delay: float):
+        openai_scheduler.submit(lambda: _attempt(n, delay), lane=lane, user_id=user_id, est_tokens=est_tokens)
+
+    def _attempt(n: int, delay: float):
+        if outer.cancelled():
+            return  # результат уже не нужен (например, проиграл гонку STT)
+        openai_stats["inflight"] += 1
+        try:
+            res = fn(*args, **kwargs)
+        except (AuthenticationError, BadRequestError) as e:
+            print(f"[{tag}] Auth/BadRequest error: {e}")
+            openai_stats["failed"] += 1
+            if not outer.cancelled():
+                outer.set_exception(e)
+            return
+        except Exception as e:
+            limit = max_retries
+            if isinstance(e, RateLimitError):
+                openai_stats["rate_limited"] += 1
+                openai_scheduler.penalize()
+                limit = max(max_retries, OPENAI_RATE_LIMIT_RETRIES)
+            print(f"[{tag}] error (попытка {n}/{limit}): {e}")
+            if n >= limit:
+                openai_stats["failed"] += 1
+                if not outer.cancelled():
+                    outer.set_exception(e)
+                return
+            pause = delay + random.uniform(0, 0.5)
+            openai_stats["retries"] += 1
+            print(f"[{tag}] повтор через {pause:.1f} с")
+            threading.Timer(pause, _schedule, args=(n + 1, delay * 2)).start()
+            return
+        finally:
+            openai_stats["inflight"] -= 1
+        if not outer.cancelled():
+            outer.set_result(res)
+
+    _schedule(1, 1.0)
+    return outer
+
+def _stt_call(audio: bytes, **kwargs):
+    # bytes, а не открытый файл: ретрай может загрузить их ещё раз
+    stt_stats["calls"] += 1
+    return client.audio.transcriptions.create(file=("audio.ogg", audio, "audio/ogg"), **kwargs)
+
+def transcribe_async(audio: bytes, user_id=None, lane: int = LANE_FREE, **kwargs) -> Future:
+    """Распознавание ogg из памяти через планировщик OpenAI; Future с текстом (может быть пустым)."""
+    fut = Future()
+    inner = openai_submit(_stt_call, audio, max_retries=2, tag="stt", user_id=user_id, lane=lane,
+                          model="gpt-4o-mini-transcribe", temperature=0, **kwargs)
+
+    def _done(f):
+        if fut.cancelled() or f.cancelled():
+            return
+        if f.exception() is not None:
+            fut.set_exception(f.exception())
+        else:
+            fut.set_result((getattr(f.result(), "text", "") or "").strip())
+
+    inner.add_done_callback(_done)
+    fut.add_done_callback(lambda f: f.cancelled() and inner.cancel())
+    return fut
+
 # ===== Аудио обработка =====
-def _tg_download_to_tmp(message):
-    """Скачивает voice/audio/document → возвращает путь к локальному файлу."""
+# Без временных файлов: Telegram → ffmpeg (stdin/stdout) → bytes → STT. Подробности в audio_pipeline.py
+import math
+from audio_pipeline import (AudioPipelineError, AudioTooLarge, iter_http, to_stt_ogg, silence_filter, ogg_opus_duration,
+                            silence_points, plan_chunks, cut_ogg, merge_overlap)
+
+AUDIO_MAX_DOWNLOAD_MB = int(os.getenv("AUDIO_MAX_DOWNLOAD_MB", "20"))  # Bot API больше 20 МБ всё равно не отдаёт
+AUDIO_MAX_STT_MB = int(os.getenv("AUDIO_MAX_STT_MB", "25"))  # лимит загрузки в transcriptions
+# обрезка тишины перед STT: платим за речь, а не за паузы; лимит секунд тоже считаем по речи
+AUDIO_TRIM_SILENCE = os.getenv("AUDIO_TRIM_SILENCE", "0") == "1"
+AUDIO_SILENCE_DB = float(os.getenv("AUDIO_SILENCE_DB", "-45"))
+AUDIO_MIN_PAUSE = float(os.getenv("AUDIO_MIN_PAUSE", "0.7"))
+AUDIO_MIN_SPEECH_SEC = 0.3
+_AUDIO_FILTER = silence_filter(AUDIO_SILENCE_DB, AUDIO_MIN_PAUSE) if AUDIO_TRIM_SILENCE else None
+trim_stats = {"clips": 0, "secs_in": 0.0, "secs_out": 0.0, "silent": 0}
+_tg_http = _make_http_session(int(os.getenv("AUDIO_JOBS", "6")))
+
+def _available_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))  # учитывает ограничения контейнера по CPU-set
+    except Exception:
+        return os.cpu_count() or 1
+
+class TranscodePool:
+    """
+    ffmpeg не больше, чем ядер. Аудио-задачи проходят допуск (admit) ещё в обработчике:
+    если в системе уже workers + max_queue клипов, новый отбиваем сразу, а не копим очередь,
+    которая съест память и потоки у текстовых переводов.
+    """
+
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._ex = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="transcode")
+        self._lock = threading.Lock()
+        self.pending = 0   # допущенные аудио-задачи, ещё не завершившиеся
+        self.running = 0   # ffmpeg прямо сейчас
+        self.waiting = 0   # ждут свободного ffmpeg
+        self.waits_ms = deque(maxlen=500)
+        self.stats = {"admitted": 0, "queued": 0, "rejected": 0, "transcoded": 0}
+
+    def admit(self):
+        """None — мест нет; иначе сколько задач впереди сверх свободных слотов (0 — начнём сразу)."""
+        with self._lock:
+            if self.pending >= self.workers + self.max_queue:
+                self.stats["rejected"] += 1
+                return None
+            self.pending += 1
+            self.stats["admitted"] += 1
+            ahead = max(0, self.pending - self.workers)
+            if ahead:
+                self.stats["queued"] += 1
+            return ahead
+
+    def release(self):
+        with self._lock:
+            self.pending -= 1
+
+    def run(self, fn, *args, **kwargs):
+        """Выполняет fn в пуле перекодирования и ждёт результат."""
+        enq = time.time()
+        with self._lock:
+            self.waiting += 1
+
+        def _job():
+            with self._lock:
+                self.waiting -= 1
+                self.running += 1
+                self.waits_ms.append((time.time() - enq) * 1000)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.stats["transcoded"] += 1
+
+        return self._ex.submit(_job).result()
+
+    def stats_line(self) -> str:
+        w = list(self.waits_ms)
+        s = self.stats
+        return (
+            f"ffmpeg: {self.running}/{self.workers}, ждут {self.waiting}, в системе {self.pending}/{self.workers + self.max_queue}; "
+            f"ожидание p50 {_percentile(w, 50):.0f} мс, p90 {_percentile(w, 90):.0f} мс; "
+            f"допущено {s['admitted']}, в очередь {s['queued']}, отказов {s['rejected']}"
+        )
+
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", "0")) or _available_cores()
+TRANSCODE_QUEUE_MAX = int(os.getenv("TRANSCODE_QUEUE_MAX", str(4 * TRANSCODE_WORKERS)))
+transcode_pool = TranscodePool(TRANSCODE_WORKERS, TRANSCODE_QUEUE_MAX)
+AUDIO_BUSY_MSG = "🚦 Сейчас много аудио, я не успеваю. Пришли, пожалуйста, через минуту."
+
+def _tg_audio_obj(message):
+    """voice/audio/document → (объект файла Telegram, расширение)."""
     if message.voice:
-        file_id = message.voice.file_id
-        ext = ".ogg"
-    elif message.audio:
-        file_id = message.audio.file_id
-        ext = os.path.splitext(message.audio.file_name or "")[1] or ".m4a"
-    elif message.document:
-        file_id = message.document.file_id
-        ext = os.path.splitext(message.document.file_name or "")[1] or ".bin"
-    else:
-        raise RuntimeError("Неизвестный тип аудио")
-    
+        return message.voice, ".ogg"
+    if message.audio:
+        return message.audio, os.path.splitext(message.audio.file_name or "")[1] or ".m4a"
+    if message.document:
+        return message.document, os.path.splitext(message.document.file_name or "")[1] or ".bin"
+    raise RuntimeError("Неизвестный тип аудио")
+
+def _tg_audio_source(message):
+    """voice/audio/document → (file_id, расширение, размер в байтах или 0)."""
+    obj, ext = _tg_audio_obj(message)
+    return obj.file_id, ext, obj.file_size or 0
+
+def _tg_file_url(file_path: str) -> str:
+    return (telebot.apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}").format(TOKEN, file_path)
+
+def load_audio_for_stt(message) -> bytes:
+    """Скачивает аудио потоком и сразу перекодирует в ogg 16kHz mono; на диск ничего не пишется."""
+    file_id, ext, size = _tg_audio_source(message)
+    limit = AUDIO_MAX_DOWNLOAD_MB * 1024 * 1024
+    if size > limit:
+        raise AudioTooLarge(f"{size // (1024 * 1024)} МБ > {AUDIO_MAX_DOWNLOAD_MB} МБ")
     f = bot.get_file(file_id)
-    raw = bot.download_file(f.file_path)
-    fd, path = tempfile.mkstemp(prefix="audio_", suffix=ext)
-    os.close(fd)
-    
-    with open(path, "wb") as out:
-        out.write(raw)
-    return path
-
-def _ensure_ogg(input_path):
-    """Если уже ogg/opus — вернём как есть. Иначе перекодируем в ogg 16kHz mono."""
-    low = input_path.lower()
-    if low.endswith(".ogg") or low.endswith(".oga"):
-        return input_path
-    
-    out_path = os.path.splitext(input_path)[0] + ".ogg"
-    subprocess.run(
-        ["ffmpeg", "-y", "-i", input_path, "-ar", "16000", "-ac", "1", "-c:a", "libopus", out_path],
-        check=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
-    return out_path
+    chunks = iter_http(_tg_http, _tg_file_url(f.file_path), limit)
+    return transcode_pool.run(to_stt_ogg, chunks, ext, max_out_bytes=AUDIO_MAX_STT_MB * 1024 * 1024,
+                              audio_filter=_AUDIO_FILTER)
+
+# ---- Стратегия STT: один проход с подсказкой языка вместо «авто, а потом ещё раз с he» ----
+STT_HE_KWARGS = {"language": "he", "prompt": "Transcribe verbatim in Hebrew script (UTF-8). Do not translate."}
+STT_HISTORY_LEN = 10
+STT_HE_MIN_CLIPS = int(os.getenv("STT_HE_MIN_CLIPS", "3"))     # сколько клипов нужно, чтобы доверять истории
+STT_HE_SHARE = float(os.getenv("STT_HE_SHARE", "0.8"))         # доля ивритских клипов → сразу language=he
+# без уверенной истории: по умолчанию «авто, а без иврита — ещё раз с he» (один вызов, если авто узнало иврит);
+# STT_RACE=1 — оба варианта параллельно: быстрее, но почти всегда две загрузки
+STT_RACE = os.getenv("STT_RACE", "0") == "1"
+stt_lang_history = LocalCache("stt_lang", max_items=5000, ttl=90 * 24 * 3600)  # uid -> [1/0 по последним клипам]
+stt_stats = {"he_direct": 0, "he_fallback_auto": 0, "race_auto": 0, "race_he": 0,
+             "seq_auto": 0, "seq_he": 0, "empty": 0, "calls": 0, "clips": 0}  # calls — реальные загрузки в API
+
+def _stt_strategy(user_id) -> str:
+    hist = stt_lang_history.get(str(user_id)) or []
+    if len(hist) >= STT_HE_MIN_CLIPS and sum(hist) / len(hist) >= STT_HE_SHARE:
+        return "he"
+    return "race" if STT_RACE else "seq"
+
+def _stt_remember(user_id, text: str):
+    key = str(user_id)
+    hist = (stt_lang_history.get(key) or []) + [1 if contains_hebrew(text) else 0]
+    stt_lang_history.set(key, hist[-STT_HISTORY_LEN:])
+
+def _stt_result(fut: Future) -> str:
+    try:
+        return fut.result()
+    except Exception as e:
+        print("[stt] attempt failed:", e)
+        return ""
+
+def _stt_race(audio: bytes, user_id, lane: int) -> str:
+    """Авто и he одновременно; берём первый ответ с ивритом, второй запрос отменяем, если он ещё в очереди."""
+    auto = transcribe_async(audio, user_id=user_id, lane=lane)
+    he = transcribe_async(audio, user_id=user_id, lane=lane, **STT_HE_KWARGS)
+    names = {auto: "race_auto", he: "race_he"}
+    pending, texts = {auto, he}, {}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for f in done:
+            texts[f] = _stt_result(f)
+            if contains_hebrew(texts[f]):
+                for other in pending:
+                    other.cancel()
+                stt_stats[names[f]] += 1
+                return texts[f]
+    return texts[he] or texts[auto]
+
+def transcribe_for_user(audio: bytes, user_id, lane: int = LANE_FREE) -> str:
+    """
+    Пользователи, которые шлют иврит, сразу получают language=he — один вызов вместо двух.
+    Без истории (или со смешанной) — старая последовательная схема либо, при STT_RACE=1, гонка двух вариантов.
+    """
+    strategy = _stt_strategy(user_id)
+    stt_stats["clips"] += 1
+    if strategy == "he":
+        text = _stt_result(transcribe_async(audio, user_id=user_id, lane=lane, **STT_HE_KWARGS))
+        if text:
+            stt_stats["he_direct"] += 1
+        else:
+            # тишина или вовсе не иврит — одна попытка с автоопределением
+            text = _stt_result(transcribe_async(audio, user_id=user_id, lane=lane))
+            stt_stats["he_fallback_auto"] += 1
+    elif strategy == "race":
+        text = _stt_race(audio, user_id, lane)
+    else:
+        text = _stt_result(transcribe_async(audio, user_id=user_id, lane=lane))
+        if contains_hebrew(text):
+            stt_stats["seq_auto"] += 1
+        else:
+            text = _stt_result(transcribe_async(audio, user_id=user_id, lane=lane, **STT_HE_KWARGS)) or text
+            stt_stats["seq_he"] += 1
+    if text:
+        _stt_remember(user_id, text)
+    else:
+        stt_stats["empty"] += 1
+    return text
+
+# ---- Длинное премиум-аудио: куски по паузам, параллельный STT, текст показываем по мере готовности ----
+STT_CHUNK_MIN_SEC = int(os.getenv("STT_CHUNK_MIN_SEC", "120"))   # короче — одним запросом
+STT_CHUNK_SEC = int(os.getenv("STT_CHUNK_SEC", "60"))
+STT_CHUNK_OVERLAP = float(os.getenv("STT_CHUNK_OVERLAP", "1.5"))
+STT_CHUNK_FANOUT = int(os.getenv("STT_CHUNK_FANOUT", "3"))       # одновременных запросов на один клип
+STT_PROGRESS_MAX_CHARS = 3800                                    # дальше — новое сообщение (лимит Telegram 4096)
+chunk_stats = {"clips": 0, "chunks": 0, "first_text_ms": deque(maxlen=200)}
+
+class _ProgressiveTranscript:
+    """
+    Расшифровка в чате, которая дописывается по мере готовности кусков.
+    Длинный текст режем по словам на сообщения не длиннее STT_PROGRESS_MAX_CHARS.
+    Это только показ: ошибка Telegram здесь не должна ронять распознавание.
+    """
 
-def process_audio(message):
+    def __init__(self, chat_id: int, total: int):
+        self.chat_id = chat_id
+        self.total = total
+        self.offset = 0        # с какого символа текста начинается текущее сообщение
+        self.shown = ""        # всё, что сейчас видно в чате
+        self.message_id = None
+
+    def _show(self, body: str):
+        if self.message_id is None:
+            self.message_id = bot.send_message(self.chat_id, body).message_id
+        else:
+            _safe_edit(self.chat_id, self.message_id, body)
+
+    def update(self, text: str, done: int):
+        head = f"🎙 Расшифровка ({done}/{self.total})…" if done < self.total else "🎙 Расшифровка:"
+        try:
+            while True:
+                start = len(text) - len(text[self.offset:].lstrip())
+                if len(text) - start <= STT_PROGRESS_MAX_CHARS:
+                    self._show(f"{head}\n{text[start:]}")
+                    break
+                # не влезает — заполняем текущее сообщение до границы слова, остальное пойдёт новым
+                cut = text.rfind(" ", start + 1, start + STT_PROGRESS_MAX_CHARS)
+                if cut == -1:
+                    cut = start + STT_PROGRESS_MAX_CHARS
+                self._show(f"{head}\n{text[start:cut]}")
+                self.offset, self.message_id = cut, None
+            self.shown = text
+        except Exception as e:
+            print(f"[stt_chunks] показ прогресса не удался: {e}")
+
+def transcribe_chunked(audio: bytes, user_id, lane: int, chat_id: int = None) -> tuple[str, bool]:
+    """
+    Режем ogg по паузам на куски ~STT_CHUNK_SEC с перекрытием, распознаём не больше
+    STT_CHUNK_FANOUT кусков одновременно, склеиваем по порядку, убирая повтор на стыках.
+    Готовое начало сразу показываем в чате — первые слова через секунды, а не после всего клипа.
+    Возвращает (текст, показан ли он в чате целиком) — если показ где-то сорвался, расшифровку пришлём заново.
+    """
+    t0 = time.time()
+    duration = ogg_opus_duration(audio)
+    silences = transcode_pool.run(silence_points, audio)
+    spans = plan_chunks(duration, silences, STT_CHUNK_SEC, STT_CHUNK_SEC * 1.5, STT_CHUNK_OVERLAP)
+    chunk_stats["clips"] += 1
+    chunk_stats["chunks"] += len(spans)
+    # язык решаем один раз на клип: без уверенной истории — авто и повтор с he для куска без иврита
+    he_first = _stt_strategy(user_id) == "he"
+    progress = _ProgressiveTranscript(chat_id, len(spans)) if chat_id else None
+
+    def _submit(idx: int, piece: bytes, he: bool, fallback: str = ""):
+        fut = transcribe_async(piece, user_id=user_id, lane=lane, **(STT_HE_KWARGS if he else {}))
+        inflight[fut] = (idx, piece, he, fallback)
+
+    inflight, texts, merged, emitted, nxt = {}, {}, "", 0, 0
+    while emitted < len(spans):
+        while nxt < len(spans) and len(inflight) < STT_CHUNK_FANOUT:
+            start, end = spans[nxt]
+            _submit(nxt, transcode_pool.run(cut_ogg, audio, start, end), he_first)
+            nxt += 1
+        done, _ = wait(list(inflight), return_when=FIRST_COMPLETED)
+        for f in done:
+            idx, piece, he, fallback = inflight.pop(f)
+            text = _stt_result(f)
+            if not he and not contains_hebrew(text):
+                _submit(idx, piece, True, fallback=text)
+                continue
+            texts[idx] = text or fallback
+        before = emitted
+        while emitted in texts:
+            merged = merge_overlap(merged, texts.pop(emitted))
+            emitted += 1
+        if emitted > before and progress and merged:
+            if not progress.shown:
+                chunk_stats["first_text_ms"].append((time.time() - t0) * 1000)
+            progress.update(merged, emitted)
+    return merged, bool(progress and merged and progress.shown == merged)
+
+# ---- Кэш расшифровок по file_unique_id: пересланный всем один и тот же голосовой — без скачивания и STT ----
+STT_CACHE_TTL = int(os.getenv("STT_CACHE_TTL_DAYS", "30")) * 24 * 3600
+stt_cache = LocalCache("stt", max_items=2000, max_disk_items=50000, ttl=STT_CACHE_TTL)
+stt_flight = SingleFlight("stt")
+
+def _transcribe_uncached(message, cache_key: str = "", chat_id: int = None) -> dict:
+    uid = message.from_user.id
+    # 1-2) скачали voice/audio/document и привели к ogg 16kHz mono — в памяти (и срезали тишину, если включено)
+    audio = load_audio_for_stt(message)
+    speech = None
+    if _AUDIO_FILTER:
+        speech = ogg_opus_duration(audio)
+        raw = getattr(_tg_audio_obj(message)[0], "duration", None) or 0
+        trim_stats["clips"] += 1
+        trim_stats["secs_in"] += raw
+        trim_stats["secs_out"] += speech
+        print(f"[audio] тишина: {raw} с → {speech:.1f} с речи (−{max(0.0, raw - speech):.1f} с)")
+        if speech < AUDIO_MIN_SPEECH_SEC:
+            trim_stats["silent"] += 1
+            return {"text": "", "translated": "", "speech_secs": 0}
+    # 3) распознавание: язык выбираем по истории пользователя (см. transcribe_for_user);
+    #    длинное премиум-аудио — кусками, с показом текста по ходу
+    lane = user_lane(uid)
+    streamed = False
+    if lane == LANE_PREMIUM and (speech or ogg_opus_duration(audio)) >= STT_CHUNK_MIN_SEC:
+        text, streamed = transcribe_chunked(audio, uid, lane, chat_id=chat_id)
+        if text:
+            _stt_remember(uid, text)
+    else:
+        text = transcribe_for_user(audio, uid, lane=lane)
+    if not text:
+        return {"text": "", "translated": "", "speech_secs": speech}
+    # 4) перевод распознанного текста
+    res = {"text": text, "translated": translate_text(text), "speech_secs": speech}
+    if cache_key and res["translated"] != TRANSLATE_ERROR:
+        stt_cache.set(cache_key, res)
+    # расшифровку этот чат уже видел по кускам — повторять её не нужно (в кэш флаг не попадает)
+    return dict(res, streamed_to=chat_id) if streamed else res
+
+def transcribe_message(message) -> dict:
+    """{"text", "translated"} для голосового/аудио: кэш → один общий прогон на одинаковый клип."""
+    obj, _ = _tg_audio_obj(message)
+    key = getattr(obj, "file_unique_id", None)
+    if not key:
+        return _transcribe_uncached(message, chat_id=message.chat.id)
+    hit = stt_cache.get(key)
+    if hit is not None:
+        _stt_remember(message.from_user.id, hit["text"])
+        return hit
+    return stt_flight.do(key, _transcribe_uncached, message, key, message.chat.id)
+
+def _split_words(text: str, limit: int = STT_PROGRESS_MAX_CHARS) -> list:
+    """Режем длинный текст по словам на куски не длиннее limit (лимит Telegram — 4096)."""
+    parts, cur = [], ""
+    for word in text.split(" "):
+        if cur and len(cur) + 1 + len(word) > limit:
+            parts.append(cur)
+            cur = word
+        else:
+            cur = f"{cur} {word}" if cur else word
+    parts.append(cur)
+    return parts
+
+def _send_transcript_parts(chat_id: int, text: str):
+    for i, part in enumerate(_split_words(text)):
+        bot.send_message(chat_id, f"🎙 Расшифровка:\n{part}" if i == 0 else part)
+
+def _send_translation_parts(chat_id: int, translated: str):
+    """Перевод длинного аудио может не влезть в одно сообщение — режем по словам, кнопки у последнего."""
+    parts = _split_words(translated)
+    for i, part in enumerate(parts):
+        head = "📘 Перевод:\n" if i == 0 else ""
+        last = i == len(parts) - 1
+        bot.send_message(chat_id, f"{head}*{part}*", parse_mode="Markdown",
+                         reply_markup=get_keyboard() if last else None)
+
+def process_audio(message, charged_secs: int = 0):
     chat_id = message.chat.id
     try:
-        # 1) скачали voice/audio/document
-        local_file = _tg_download_to_tmp(message)
-        # 2) привели к ogg 16kHz mono (если нужно)
-        file_for_stt = _ensure_ogg(local_file)
-
-        # 3) первая попытка распознавания (автоопределение)
-        with open(file_for_stt, "rb") as f:
-            tr = client.audio.transcriptions.create(
-                model="gpt-4o-mini-transcribe",
-                file=f,
-                temperature=0
-            )
-        text = (getattr(tr, "text", "") or "").strip()
+        res = transcribe_message(message)
+        text, translated = res["text"], res["translated"]
 
-        # 3b) если иврита не распознало — повтор с принудительным языком
-        if not text or not contains_hebrew(text):
-            try:
-                with open(file_for_stt, "rb") as f:
-                    tr2 = client.audio.transcriptions.create(
-                        model="gpt-4o-mini-transcribe",
-                        file=f,
-                        language="he",  # <- ключевая строка
-                        temperature=0,
-                        prompt="Transcribe verbatim in Hebrew script (UTF-8). Do not translate."
-                    )
-                text2 = (getattr(tr2, "text", "") or "").strip()
-                if text2:
-                    text = text2
-            except Exception as e:
-                print("[stt] second attempt (language=he) failed:", e)
+        # в лимит засчитываем только речь: срезанную тишину возвращаем
+        if charged_secs and res.get("speech_secs") is not None:
+            refund_audio_secs(message.from_user.id, charged_secs - math.ceil(res["speech_secs"]))
 
         if not text:
             bot.send_message(chat_id, "⚠️ Не удалось распознать речь.")
             return
 
-        # 4) перевод распознанного текста
-        translated = translate_text(text)
-
         # 5) сохранить текст для кнопок «🧠 Объяснить» и «🔄 Новый перевод»
         user_translations[chat_id] = text
         user_engine[chat_id] = "google"
@@ -606,7 +2279,15 @@ def process_audio(message):
             f"🎙 Расшифровка:\n{text}\n\n"
             f"📘 Перевод:\n*{translated}*"
         )
-        bot.send_message(chat_id, msg, parse_mode="Markdown", reply_markup=get_keyboard())
+        if res.get("streamed_to") == chat_id:
+            # расшифровка уже в чате (длинное аудио по кускам) — досылаем только перевод
+            _send_translation_parts(chat_id, translated)
+        elif len(msg) > STT_PROGRESS_MAX_CHARS:
+            # длинный клип из кэша или от чужого прогона: одним сообщением Telegram не примет
+            _send_transcript_parts(chat_id, text)
+            _send_translation_parts(chat_id, translated)
+        else:
+            bot.send_message(chat_id, msg, parse_mode="Markdown", reply_markup=get_keyboard())
 
         # 7) история
         try:
@@ -614,10 +2295,38 @@ def process_audio(message):
         except Exception as e:
             print("[history audio] err:", e)
 
+    except AudioTooLarge as e:
+        print("[audio] слишком большой файл:", e)
+        bot.send_message(chat_id, f"⚠️ Файл слишком большой (максимум {AUDIO_MAX_DOWNLOAD_MB} МБ).")
+    except AudioPipelineError as e:
+        print("[audio] ffmpeg:", e)
+        bot.send_message(chat_id, "⚠️ Не удалось прочитать аудиофайл.")
     except Exception as e:
         print("Ошибка аудио:", e)
         bot.send_message(chat_id, "⚠️ Ошибка при расшифровке аудио.")
 
+def _audio_job(message, charged_secs: int = 0):
+    try:
+        process_audio(message, charged_secs)
+    finally:
+        transcode_pool.release()
+
+def submit_audio_job(message, charged_secs: int = 0, ahead: int = None) -> bool:
+    """
+    Допуск + постановка в очередь. ahead — результат transcode_pool.admit(), если место уже занял
+    вызывающий (handle_voice берёт его до списания лимитов); иначе допуск делаем здесь.
+    False — перегружены, пользователь уже получил ответ.
+    """
+    if ahead is None:
+        ahead = transcode_pool.admit()
+        if ahead is None:
+            bot.send_message(message.chat.id, AUDIO_BUSY_MSG)
+            return False
+    if ahead:
+        bot.send_message(message.chat.id, f"⏳ Много аудио, твоё в очереди (впереди {ahead}). Расшифрую, как только освобожусь.")
+    _AUDIO_JOBS.submit(_audio_job, message, charged_secs)
+    return True
+
 # ===== История переводов =====
 def _history_ref(user_id: int):
     return db.collection("users").document(str(user_id)).collection("history")
@@ -834,9 +2543,8 @@ def _weekly_now(m):
     bot.send_message(m.chat.id, f"📣 Отправлен '{WEEKLY_POLL_KEY}' всем.")
 def _mark_user_blocked(user_id: int, reason: str = "blocked"):
     try:
-        db.collection("users").document(str(user_id)).set(
-            {"blocked": True, "blocked_reason": reason, "blocked_ts": datetime.utcnow().isoformat()},
-            merge=True
+        user_profiles.set_fields(
+            user_id, {"blocked": True, "blocked_reason": reason, "blocked_ts": datetime.utcnow().isoformat()}
         )
     except Exception as e:
         print(f"[blocked] mark err for {user_id}: {e}")
@@ -933,9 +2641,11 @@ def cmd_phrase_dedup(m):
     bot.send_message(m.chat.id, "\n".join(lines))
 @bot.message_handler(commands=['phrases_reload'])
 def cmd_phrases_reload(m):
-    global phrase_db
+    global phrase_db, phrase_index, pregen_explanations
     phrase_db = load_phrase_db()
-    bot.send_message(m.chat.id, f"🔄 Перезагружено. Фраз: {len(phrase_db)}")
+    phrase_index = build_phrase_index()
+    pregen_explanations = load_pregenerated(PREGEN_FILE, EXPLAIN_SYS_PROMPT)
+    bot.send_message(m.chat.id, f"🔄 Перезагружено. Фраз: {len(phrase_db)}, в офлайн-индексе: {len(phrase_index)}")
 
 def build_pod_message(item):
     return (
@@ -1004,20 +2714,16 @@ def get_next_phrase_item():
     idx = _next_index_txn("meta/phrases", "last_index", len(phrase_db))
     return phrase_db[idx]
 def _get_last_fact_date(user_id):
-    doc = db.collection("users").document(str(user_id)).get()
-    d = doc.to_dict() or {}
-    return d.get("last_fact")
+    return user_profiles.get(user_id).get("last_fact")
 
 def _set_last_fact_date(user_id, date_iso):
-    db.collection("users").document(str(user_id)).set({"last_fact": date_iso}, merge=True)
+    user_profiles.set_fields(user_id, {"last_fact": date_iso})
 
 def _get_last_pod_date(user_id):
-    doc = db.collection("users").document(str(user_id)).get()
-    d = doc.to_dict() or {}
-    return d.get("last_pod")
+    return user_profiles.get(user_id).get("last_pod")
 
 def _set_last_pod_date(user_id, date_iso):
-    db.collection("users").document(str(user_id)).set({"last_pod": date_iso}, merge=True)
+    user_profiles.set_fields(user_id, {"last_pod": date_iso})
 
 def send_phrase_of_the_day_now():
     item = get_next_phrase_item()
@@ -1194,6 +2900,94 @@ def _schedule_next_20():
 # включаем планировщик фактов (ровно один раз в файле!)
 _schedule_next_20()
 
+# ===== ОФЛАЙН-ИНДЕКС ФРАЗ (до любого сетевого перевода) =====
+HE_PREFIX_LETTERS = "והבלש"  # приставки-союзы/предлоги, которые пробуем отрезать
+_EDGE_PUNCT_RE = re.compile(r"^[\s.,!?;:…\-–—«»()]+|[\s.,!?;:…\-–—«»()]+$")
+
+def _phrase_index_key(s: str) -> str:
+    return _EDGE_PUNCT_RE.sub("", norm_text_key(s))
+
+class PhraseIndex:
+    """
+    Словарь уже известных нам фраз: phrases.json, факты, FALLBACK_PHRASES и IDIOMS.
+    Поиск: точное совпадение → совпадение без никуда/кавычек/краевой пунктуации →
+    то же после отрезания 1–2 приставок ו/ה/ב/ל/ש у первого слова.
+    """
+
+    def __init__(self):
+        self.exact = {}
+        self.norm = {}
+
+    def add(self, he: str, ru: str, note: str, source: str):
+        he = (he or "").strip()
+        key = _phrase_index_key(he)
+        if not key:
+            return
+        entry = {"he": he, "ru": (ru or "").strip(), "note": (note or "").strip(), "source": source}
+        # первым добавляется самый курируемый источник — его и оставляем
+        self.exact.setdefault(he, entry)
+        self.norm.setdefault(key, entry)
+
+    def __len__(self):
+        return len(self.norm)
+
+    def lookup(self, text: str):
+        text = (text or "").strip()
+        if text in self.exact:
+            return self.exact[text]
+        key = _phrase_index_key(text)
+        if key in self.norm:
+            return self.norm[key]
+        stripped = key
+        for _ in range(2):
+            if len(stripped) > 3 and stripped[0] in HE_PREFIX_LETTERS:
+                stripped = stripped[1:]
+                hit = self.norm.get(stripped)
+                if hit:
+                    return {**hit, "prefix_of": text}
+            else:
+                break
+        return None
+
+def build_phrase_index() -> PhraseIndex:
+    idx = PhraseIndex()
+    for it in phrase_db:
+        idx.add(it.get("he"), it.get("ru"), it.get("note"), "phrases")
+    try:
+        for it in _load_facts():
+            idx.add(it.get("he"), it.get("ru"), it.get("note"), "facts")
+    except Exception as e:
+        print(f"[phrase_index] facts err: {e}")
+    for it in FALLBACK_PHRASES:
+        idx.add(it.get("he"), it.get("ru"), it.get("note"), "fallback")
+    for he, note in idiom_matcher.idioms.items():
+        idx.add(he, "", note, "idioms")
+    print(f"[phrase_index] {len(idx)} фраз в офлайн-индексе")
+    return idx
+
+phrase_index = build_phrase_index()
+local_lookup_stats = {"hits": 0, "misses": 0}
+
+def render_local_translation(hit: dict) -> tuple[str, str]:
+    """Готовый ответ из словаря. Возвращает (перевод для истории, текст сообщения)."""
+    translated = hit["ru"] or hit["note"]
+    lines = [f"📘 Перевод:\n*{translated}*"]
+    if hit["ru"] and hit["note"]:
+        lines.append(f"💬 {hit['note']}")
+    if hit.get("prefix_of"):
+        lines.append(f"ℹ️ Нашла в словаре как «{hit['he']}» (с приставкой).")
+    return translated, "\n".join(lines)
+
+def translate_local_first(text: str) -> tuple[str, str]:
+    """Сначала офлайн-индекс, потом уже внешний переводчик. Возвращает (перевод, текст сообщения)."""
+    hit = phrase_index.lookup(text)
+    if hit:
+        local_lookup_stats["hits"] += 1
+        return render_local_translation(hit)
+    local_lookup_stats["misses"] += 1
+    translated = translate_text(text)
+    return translated, f"📘 Перевод:\n*{translated}*"
+
 # ===== ВИКТОРИНА =====
 QUIZ_COLL = "quiz"
 QUIZ_DOC = "current"
@@ -1284,38 +3078,316 @@ def _reset_current(user_id):
     _quiz_state_ref(user_id).delete()
 
 # ===== Функция для работы с OpenAI =====
-def ask_gpt(messages, model="gpt-4o", max_retries=3):
-    """Запрос к OpenAI с ретраями и экспоненциальной паузой."""
-    delay = 1.0
-    for attempt in range(1, max_retries + 1):
+def _chat_completion(messages, model: str, usage=None, max_tokens: int = 300) -> str:
+    t0 = time.perf_counter()
+    resp = client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=0.4,
+        timeout=30,
+        max_tokens=max_tokens
+    )
+    if usage is not None:
+        usage["ms"] = (time.perf_counter() - t0) * 1000
+        if getattr(resp, "usage", None):
+            usage["prompt_tokens"] = resp.usage.prompt_tokens or 0
+            usage["completion_tokens"] = resp.usage.completion_tokens or 0
+    return resp.choices[0].message.content.strip()
+
+def _usage_tokens(usage: dict) -> int:
+    return int(usage.get("prompt_tokens", 0)) + int(usage.get("completion_tokens", 0))
+
+def _estimate_tokens(messages, max_tokens: int = 300) -> int:
+    # грубо: ~2 символа на токен для иврита/кириллицы + сколько можем получить в ответ
+    return sum(len(m.get("content") or "") for m in messages) // 2 + max_tokens
+
+def ask_gpt_async(messages, model="gpt-4o", max_retries=3, usage=None, user_id=None, lane=LANE_FREE,
+                  max_tokens: int = 300) -> Future:
+    """
+    Запрос к OpenAI через планировщик с ретраями. Future → текст, None (если все попытки упали),
+    или исключение Auth/BadRequest.
+    """
+    fut = Future()
+    inner = openai_submit(_chat_completion, messages, model, usage, max_tokens, max_retries=max_retries, tag="ask_gpt",
+                          user_id=user_id, lane=lane, est_tokens=_estimate_tokens(messages, max_tokens))
+
+    def _done(f):
+        e = f.exception()
+        if isinstance(e, (AuthenticationError, BadRequestError)):
+            fut.set_exception(e)
+        else:
+            fut.set_result(None if e is not None else f.result())
+
+    inner.add_done_callback(_done)
+    return fut
+
+# промпт живёт рядом с пакетной пред-генерацией, чтобы ключи у бота и у батча совпадали
+from pregen_explanations import EXPLAIN_SYS_PROMPT, prompt_hash as _prompt_hash, load_pregenerated
+explain_flight = SingleFlight("explain")
+
+# готовые объяснения для курируемых фраз/фактов (python pregen_explanations.py) — O(1) по словарю
+PREGEN_FILE = os.getenv("PREGEN_FILE") or os.path.join(BASE_DIR, "explanations.pregen.json")
+pregen_explanations = load_pregenerated(PREGEN_FILE, EXPLAIN_SYS_PROMPT)
+
+# цены $ за 1M токенов (вход, выход) — только для оценки сэкономленного в /explain_stats
+OPENAI_PRICES_PER_1M = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+}
+EXPLAIN_CACHE_TTL = int(os.getenv("EXPLAIN_CACHE_TTL", str(30 * 24 * 3600)))
+explain_cache = LocalCache("explain", max_items=2000, max_disk_items=20000, ttl=EXPLAIN_CACHE_TTL)
+explain_stats = {"hits": 0, "pregen_hits": 0, "misses": 0, "tokens_saved": 0, "usd_saved": 0.0, "usd_spent": 0.0}
+
+def _gpt_cost_usd(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    p_in, p_out = OPENAI_PRICES_PER_1M.get(model, OPENAI_PRICES_PER_1M["gpt-4o"])
+    return (prompt_tokens * p_in + completion_tokens * p_out) / 1_000_000
+
+def _explain_cache_key(model: str, text: str) -> str:
+    # хэш промпта в ключе: поменяли промпт — старые объяснения просто перестают находиться
+    return f"{model}|{_prompt_hash(EXPLAIN_SYS_PROMPT)}|{norm_text_key(text)}"
+
+# ---- Роутер моделей: модель и max_tokens по длине, числу ивритских слов и тарифу ----
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
+OPENAI_MODEL_SHORT = os.getenv("OPENAI_MODEL_SHORT") or OPENAI_MODEL  # напр. gpt-4o-mini, когда shadow это подтвердит
+ROUTER_SHORT_MAX_HE_WORDS = int(os.getenv("ROUTER_SHORT_MAX_HE_WORDS", "3"))
+ROUTER_LONG_MIN_CHARS = int(os.getenv("ROUTER_LONG_MIN_CHARS", "200"))
+# shadow: доля запросов, которые в фоне (batch-полоса) дублируем на другую модель — только для сравнения
+OPENAI_SHADOW_MODEL = os.getenv("OPENAI_SHADOW_MODEL", "")
+OPENAI_SHADOW_RATE = float(os.getenv("OPENAI_SHADOW_RATE", "0"))
+HE_WORD_RE = re.compile(r"[\u0590-\u05FF]+")
+route_stats = {}  # "route" / "shadow:route" -> счётчики
+_route_lock = threading.Lock()
+
+def route_model(text: str, premium: bool = False) -> tuple[str, str, int]:
+    """Возвращает (маршрут, модель, max_tokens)."""
+    if len(text) >= ROUTER_LONG_MIN_CHARS:
+        return "long", OPENAI_MODEL, 500
+    if len(HE_WORD_RE.findall(text)) <= ROUTER_SHORT_MAX_HE_WORDS:
+        if premium:
+            return "short_premium", OPENAI_MODEL, 200
+        return "short", OPENAI_MODEL_SHORT, 200
+    return "default", OPENAI_MODEL, 300
+
+def record_route(route: str, model: str, usage: dict, answer: str = ""):
+    cost = _gpt_cost_usd(model, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+    with _route_lock:
+        r = route_stats.setdefault(route, {"model": model, "calls": 0, "tokens": 0, "usd": 0.0, "chars": 0,
+                                           "ms": deque(maxlen=300)})
+        r["model"] = model
+        r["calls"] += 1
+        r["tokens"] += _usage_tokens(usage)
+        r["usd"] += cost
+        r["chars"] += len(answer or "")
+        if usage.get("ms"):
+            r["ms"].append(usage["ms"])
+    return cost
+
+def _maybe_shadow(route: str, model: str, messages, max_tokens: int):
+    if not OPENAI_SHADOW_MODEL or OPENAI_SHADOW_MODEL == model or random.random() >= OPENAI_SHADOW_RATE:
+        return
+    usage = {}
+    fut = ask_gpt_async(messages, model=OPENAI_SHADOW_MODEL, usage=usage, lane=LANE_BATCH,
+                        max_tokens=max_tokens, max_retries=1)
+
+    def _done(f):
+        if f.exception() is None and f.result():
+            record_route(f"shadow:{route}", OPENAI_SHADOW_MODEL, usage, f.result())
+
+    fut.add_done_callback(_done)
+
+def _explain_gpt_future(key: str, text: str, model: str, user_id=None, lane=LANE_FREE,
+                        route: str = "default", max_tokens: int = 300) -> Future:
+    """Обычный (не стриминговый) вызов GPT; удачный ответ кладём в кэш."""
+    usage = {}
+    messages = [{"role": "system", "content": EXPLAIN_SYS_PROMPT}, {"role": "user", "content": text}]
+    fut = ask_gpt_async(messages, model=model, usage=usage, user_id=user_id, lane=lane, max_tokens=max_tokens)
+
+    def _store(f):
+        if f.exception() is None and f.result() is not None:
+            cost = record_route(route, model, usage, f.result())
+            explain_stats["usd_spent"] += cost
+            explain_cache.set(key, {"text": f.result(), "tokens": _usage_tokens(usage), "usd": cost})
+
+    fut.add_done_callback(_store)
+    _maybe_shadow(route, model, messages, max_tokens)
+    return fut
+
+# ---- Стриминг объяснения с правкой сообщения на лету ----
+EXPLAIN_STREAM = os.getenv("EXPLAIN_STREAM", "1") == "1"
+EXPLAIN_EDIT_INTERVAL = float(os.getenv("EXPLAIN_EDIT_INTERVAL", "1.2"))  # Telegram не любит частые edit
+EXPLAIN_USEFUL_CHARS = 40  # столько символов уже можно читать
+explain_ttfut_ms = deque(maxlen=500)  # time-to-first-useful-text
+
+def _safe_edit(chat_id: int, message_id: int, text: str):
+    """Правка сообщения только для показа: любая ошибка Telegram (в т.ч. сетевая) — в лог, не наверх."""
+    try:
+        bot.edit_message_text(text, chat_id, message_id)
+        return True
+    except Exception as e:
+        if "message is not modified" not in str(e):
+            print(f"[explain_stream] edit err: {e}")
+        return False
+
+def _explain_offline_into(chat_id: int, mid: int, text: str, partial: str = ""):
+    """Офлайн-фолбэк в плейсхолдер стрима. Только через _OPENAI_CALLBACKS: explain_local ходит в переводчик."""
+    local = explain_local(text)
+    body = (partial + "\n\n— связь с GPT оборвалась, дальше офлайн —\n\n" + local) if partial else local
+    _safe_edit(chat_id, mid, _explanation_text(body, offline=not partial))
+
+def _explain_stream_to_chat(key: str, text: str, model: str, chat_id: int, mid: int, t0: float,
+                            route: str = "default", max_tokens: int = 300):
+    """
+    Плейсхолдер mid уже отправлен (explain_async, ещё до очереди) — правим его по мере прихода
+    токенов (не чаще EXPLAIN_EDIT_INTERVAL). Ошибка до первого токена (429, обрыв соединения)
+    уходит в openai_submit: планировщик притормозит и повторит. Если же стрим оборвался на середине —
+    офлайн-объяснение допишет _OPENAI_CALLBACKS, не занимая слот OpenAI. Возвращает полный ответ или None.
+    """
+    _safe_edit(chat_id, mid, "🧠 Объяснение:\n⏳ Думаю…")
+    messages = [{"role": "system", "content": EXPLAIN_SYS_PROMPT}, {"role": "user", "content": text}]
+    buf, usage = [], {}
+    last_edit, shown, useful_at = 0.0, 0, None
+    started = time.perf_counter()
+    try:
+        stream = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=0.4,
+            timeout=30,
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        for chunk in stream:
+            if getattr(chunk, "usage", None):
+                usage = {"prompt_tokens": chunk.usage.prompt_tokens or 0,
+                         "completion_tokens": chunk.usage.completion_tokens or 0}
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            if not delta:
+                continue
+            buf.append(delta)
+            now = time.time()
+            cur = "".join(buf)
+            if now - last_edit >= EXPLAIN_EDIT_INTERVAL and len(cur) > shown:
+                if _safe_edit(chat_id, mid, "🧠 Объяснение:\n" + cur + " ▌"):
+                    last_edit, shown = now, len(cur)
+                    if useful_at is None and len(cur) >= EXPLAIN_USEFUL_CHARS:
+                        useful_at = now
+                        explain_ttfut_ms.append((now - t0) * 1000)
+    except AuthenticationError:
+        _safe_edit(chat_id, mid, "⚠️ Проблема с ключом OpenAI. Проверь OPENAI_API_KEY.")
+        return None
+    except BadRequestError as e:
+        print(f"[explain_stream] BadRequest: {e}")
+        _safe_edit(chat_id, mid, "⚠️ Не удалось разобрать запрос для объяснения.")
+        return None
+    except Exception as e:
+        if not buf:
+            raise  # текста ещё не было — пусть openai_submit решает про паузу и повтор
+        print(f"[explain_stream] стрим оборвался после {len(''.join(buf))} симв.: {e}")
+        _OPENAI_CALLBACKS.submit(_explain_offline_into, chat_id, mid, text, "".join(buf).strip())
+        return None
+
+    answer = "".join(buf).strip()
+    if not answer:
+        _OPENAI_CALLBACKS.submit(_explain_offline_into, chat_id, mid, text)
+        return None
+    _safe_edit(chat_id, mid, _explanation_text(answer))
+    if useful_at is None:
+        explain_ttfut_ms.append((time.time() - t0) * 1000)
+
+    usage["ms"] = (time.perf_counter() - started) * 1000
+    cost = record_route(route, model, usage, answer)
+    explain_stats["usd_spent"] += cost
+    explain_cache.set(key, {"text": answer, "tokens": _usage_tokens(usage), "usd": cost})
+    return answer
+
+def _deliver_explanation(chat_id: int, text: str, fut: Future, t0: float):
+    """Колбэк на готовый Future объяснения: ответ, офлайн-фолбэк или понятная ошибка."""
+    try:
+        answer = fut.result()
+        if answer is None:
+            _send_explanation_guard(chat_id, explain_local(text), offline=True)
+        else:
+            _send_explanation_guard(chat_id, answer, offline=False)
+        explain_ttfut_ms.append((time.time() - t0) * 1000)
+    except AuthenticationError:
+        bot.send_message(chat_id, "⚠️ Проблема с ключом OpenAI. Проверь OPENAI_API_KEY.")
+    except BadRequestError as e:
+        print(f"[ask_gpt] BadRequest: {e}")
+        bot.send_message(chat_id, "⚠️ Не удалось разобрать запрос для объяснения.")
+    except Exception as e:
+        print(f"Неожиданная ошибка при объяснении: {e}")
         try:
-            resp = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=0.4,
-                timeout=30,
-                max_tokens=300
-            )
-            return resp.choices[0].message.content.strip()
-        except (APIConnectionError, RateLimitError, APIStatusError) as e:
-            print(f"[ask_gpt] API error (попытка {attempt}/{max_retries}): {e}")
-            if attempt == max_retries:
-                return None
-        except (AuthenticationError, BadRequestError) as e:
-            print(f"[ask_gpt] Auth/BadRequest error: {e}")
-            raise
+            bot.send_message(chat_id, f"🧠 Объяснение (офлайн):\n{explain_local(text)}")
+        except Exception as e2:
+            print(f"[explain] fallback err: {e2}")
+
+def explain_async(chat_id: int, text: str, user_id=None):
+    """
+    Кнопка «🧠 Объяснить»: кэш → один общий upstream-вызов на одинаковый текст.
+    Обработчик не ждёт GPT: работа идёт в пуле OpenAI, ответ отправляет колбэк Future (в _OPENAI_CALLBACKS).
+    """
+    t0 = time.time()
+    pre = pregen_explanations.get(norm_text_key(text))
+    if pre:
+        explain_stats["pregen_hits"] += 1
+        _send_explanation_guard(chat_id, pre)
+        explain_ttfut_ms.append((time.time() - t0) * 1000)
+        return
+
+    lane = user_lane(user_id)
+    route, model, max_tokens = route_model(text, premium=(lane == LANE_PREMIUM))
+    key = _explain_cache_key(model, text)
+    hit = explain_cache.get(key)
+    if hit is not None:
+        explain_stats["hits"] += 1
+        explain_stats["tokens_saved"] += int(hit.get("tokens", 0))
+        explain_stats["usd_saved"] += float(hit.get("usd", 0.0))
+        _send_explanation_guard(chat_id, hit["text"])
+        explain_ttfut_ms.append((time.time() - t0) * 1000)
+        return
+
+    explain_stats["misses"] += 1
+    if EXPLAIN_STREAM:
+        # под локом single-flight только пустой Future: плейсхолдер и постановку в очередь делаем после
+        start = Future
+    else:
+        start = lambda: _explain_gpt_future(key, text, model, user_id=user_id, lane=lane,
+                                            route=route, max_tokens=max_tokens)
+    fut, leader = explain_flight.do_future(key, start)
+
+    if leader and EXPLAIN_STREAM:
+        # плейсхолдер сразу, ещё до очереди планировщика — пользователь видит, что запрос принят
+        try:
+            mid = bot.send_message(chat_id, "🧠 Объяснение:\n⏳ В очереди…").message_id
         except Exception as e:
-            print(f"[ask_gpt] Unexpected error (попытка {attempt}/{max_retries}): {e}")
-            if attempt == max_retries:
-                return None
-        
-        if attempt < max_retries:
-            sleep_time = delay + random.uniform(0, 0.5)
-            print(f"[ask_gpt] Ждём {sleep_time:.1f} секунд перед повтором...")
-            time.sleep(sleep_time)
-            delay *= 2
-    
-    return None
+            fut.set_exception(e)  # отпускаем ключ single-flight, ждущие получат офлайн-фолбэк
+            raise
+        messages = [{"role": "system", "content": EXPLAIN_SYS_PROMPT}, {"role": "user", "content": text}]
+        _maybe_shadow(route, model, messages, max_tokens)
+        inner = openai_submit(_explain_stream_to_chat, key, text, model, chat_id, mid, t0, route, max_tokens,
+                              max_retries=2, tag="explain_stream", user_id=user_id, lane=lane,
+                              est_tokens=_estimate_tokens(messages, max_tokens))
+
+        def _relay(f):
+            if f.exception() is not None:
+                fut.set_exception(f.exception())
+            else:
+                fut.set_result(f.result())
+
+        def _failed(f):
+            # ведущий запрос сам стримит в свой чат; если все попытки исчерпаны — офлайн в тот же плейсхолдер
+            if f.exception() is None:
+                return
+            print(f"[explain_stream] err: {f.exception()}")
+            _explain_offline_into(chat_id, mid, text)
+
+        inner.add_done_callback(_relay)
+        fut.add_done_callback(off_worker(_failed))
+        return
+    fut.add_done_callback(off_worker(lambda f: _deliver_explanation(chat_id, text, f, t0)))
 
 # ===== Функции для работы с чеками =====
 def _forward_receipt_to_owner(chat_id: int, from_user, text_summary: str, photo_message=None):
@@ -1760,6 +3832,114 @@ def cmd_stats(m):
     except Exception as e:
         bot.send_message(m.chat.id, f"⚠️ Ошибка статистики: {e}")
 
+@bot.message_handler(commands=['cache_stats'])
+def cmd_cache_stats(m):
+    if not _is_admin(m.from_user.id):
+        return bot.send_message(m.chat.id, "⛔ Доступ только для администратора.")
+    lines = ["🗄 Кэши:"] + [f"• {c.stats_line()}" for c in _CACHES]
+    lines.append(f"• память предложений: текстов {tm_stats['texts']}, сегментов {tm_stats['segments']}, "
+                 f"взято из памяти {tm_stats['reused']}")
+    lines += [f"• single-flight {f.stats_line()}" for f in _FLIGHTS]
+    ls = local_lookup_stats
+    lines.append(f"• офлайн-индекс: {len(phrase_index)} фраз, попаданий {ls['hits']}, промахов {ls['misses']}")
+    lines.append(f"• {usage_ledger.stats_line()}")
+    lines.append(f"• {premium_cache.stats_line()}")
+    lines.append(f"• {user_profiles.stats_line()}")
+    c = context_stats
+    lines.append(f"• контекст апдейта: {c['updates']} апдейтов, get_all {c['batched_reads']} ({c['docs_read']} док.), "
+                 f"commit {c['commits']}, ошибок {c['errors']}")
+    bot.send_message(m.chat.id, "\n".join(lines))
+
+@bot.message_handler(commands=['tr_stats'])
+def cmd_tr_stats(m):
+    if not _is_admin(m.from_user.id):
+        return bot.send_message(m.chat.id, "⛔ Доступ только для администратора.")
+    lines = ["🌐 Движки перевода:"] + [f"• {x}" for x in translator_pool.stats_lines()]
+    lines += [f"• ⚡ {b.stats_line()}" for b in engine_breakers.values()]
+    h = hedge_stats
+    lines.append(
+        f"🏁 Хедж ({'вкл' if TRANSLATE_HEDGE else 'выкл'}, p{TRANSLATE_HEDGE_PCT:g}, сейчас {_hedge_deadline_s('google') * 1000:.0f} мс): "
+        f"вызовов {h['calls']}, запусков второго {h['hedged']}, победил основной {h['primary_won']}, "
+        f"второй {h['secondary_won']}, оба упали {h['failed']}"
+    )
+    bot.send_message(m.chat.id, "\n".join(lines))
+
+@bot.message_handler(commands=['explain_stats'])
+def cmd_explain_stats(m):
+    if not _is_admin(m.from_user.id):
+        return bot.send_message(m.chat.id, "⛔ Доступ только для администратора.")
+    e = explain_stats
+    total = e["hits"] + e["pregen_hits"] + e["misses"]
+    rate = (e["hits"] + e["pregen_hits"]) / total if total else 0.0
+    msg = (
+        "🧠 Кэш объяснений\n"
+        f"• Попаданий: {e['hits'] + e['pregen_hits']} из {total} ({rate:.0%}), "
+        f"из них готовых заранее: {e['pregen_hits']} (в файле {len(pregen_explanations)})\n"
+        f"• Сэкономлено токенов: {e['tokens_saved']} (~${e['usd_saved']:.4f})\n"
+        f"• Потрачено на новые объяснения: ~${e['usd_spent']:.4f}\n"
+        f"• Промпт: {_prompt_hash(EXPLAIN_SYS_PROMPT)}\n"
+        f"• До первого полезного текста: p50 {_percentile(list(explain_ttfut_ms), 50):.0f} мс, "
+        f"p90 {_percentile(list(explain_ttfut_ms), 90):.0f} мс (стрим {'вкл' if EXPLAIN_STREAM else 'выкл'})\n"
+        f"• {explain_cache.stats_line()}"
+    )
+    bot.send_message(m.chat.id, msg)
+
+@bot.message_handler(commands=['openai_stats'])
+def cmd_openai_stats(m):
+    if not _is_admin(m.from_user.id):
+        return bot.send_message(m.chat.id, "⛔ Доступ только для администратора.")
+    o = openai_stats
+    bot.send_message(
+        m.chat.id,
+        f"🤖 OpenAI: потоков {OPENAI_MAX_CONCURRENCY}, сейчас выполняется {o['inflight']}\n"
+        f"• Задач: {o['submitted']}, повторов: {o['retries']}, 429: {o['rate_limited']}, неудач: {o['failed']}\n"
+        f"• Аудио-задач в очереди: {_AUDIO_JOBS._work_queue.qsize()}\n"
+        f"• {transcode_pool.stats_line()}\n"
+        + "\n".join(f"• {x}" for x in openai_scheduler.stats_lines())
+    )
+
+@bot.message_handler(commands=['stt_stats'])
+def cmd_stt_stats(m):
+    if not _is_admin(m.from_user.id):
+        return bot.send_message(m.chat.id, "⛔ Доступ только для администратора.")
+    s = stt_stats
+    clips = s["clips"] or 1
+    bot.send_message(m.chat.id, "\n".join([
+        f"🎙 STT: клипов {s['clips']}, загрузок в API {s['calls']} ({s['calls'] / clips:.2f} на клип), пустых {s['empty']}",
+        f"Сразу he (по истории): {s['he_direct']}, откат на авто: {s['he_fallback_auto']}",
+        f"Гонка: выиграл авто {s['race_auto']}, выиграл he {s['race_he']}",
+        f"Последовательно: хватило авто {s['seq_auto']}, понадобился he {s['seq_he']}",
+        f"Кэш по file_unique_id: {stt_cache.stats_line()}",
+        f"Длинное аудио кусками: клипов {chunk_stats['clips']}, кусков {chunk_stats['chunks']}, "
+        f"первый текст p50 {_percentile(list(chunk_stats['first_text_ms']), 50) / 1000:.1f} с",
+        (f"Обрезка тишины: клипов {trim_stats['clips']}, {trim_stats['secs_in']:.0f} с → {trim_stats['secs_out']:.0f} с "
+         f"(−{trim_stats['secs_in'] - trim_stats['secs_out']:.0f} с), только тишина: {trim_stats['silent']}"
+         if AUDIO_TRIM_SILENCE else "Обрезка тишины: выключена (AUDIO_TRIM_SILENCE=1)"),
+        stt_flight.stats_line(),
+        f"Режим без истории: {'гонка' if STT_RACE else 'последовательно'}; "
+        f"he сразу после {STT_HE_MIN_CLIPS} клипов с долей иврита ≥{STT_HE_SHARE:.0%}",
+    ]))
+
+@bot.message_handler(commands=['router_stats'])
+def cmd_router_stats(m):
+    if not _is_admin(m.from_user.id):
+        return bot.send_message(m.chat.id, "⛔ Доступ только для администратора.")
+    lines = [
+        f"🧭 Роутер: short → {OPENAI_MODEL_SHORT} (≤{ROUTER_SHORT_MAX_HE_WORDS} слов), "
+        f"default/long → {OPENAI_MODEL} (long ≥{ROUTER_LONG_MIN_CHARS} симв.)",
+        f"Shadow: {OPENAI_SHADOW_MODEL or '—'} с долей {OPENAI_SHADOW_RATE:.0%}",
+    ]
+    with _route_lock:
+        for name, r in sorted(route_stats.items()):
+            n = r["calls"] or 1
+            ms = list(r["ms"])
+            lines.append(
+                f"• {name} [{r['model']}]: {r['calls']} выз., p50 {_percentile(ms, 50):.0f} мс, "
+                f"p90 {_percentile(ms, 90):.0f} мс, ~{r['tokens'] / n:.0f} ток./выз., "
+                f"${r['usd']:.4f} (${r['usd'] / n:.5f}/выз.), ~{r['chars'] / n:.0f} симв. ответа"
+            )
+    bot.send_message(m.chat.id, "\n".join(lines))
+
 @bot.message_handler(commands=['premium'])
 def cmd_premium(m):
     if not check_access(m.from_user.id):
@@ -1787,6 +3967,8 @@ def cmd_setpremium(m):
         _, uid, until = m.text.split(maxsplit=2)
         uid = int(uid)
         db.collection("premium_users").document(str(uid)).set({"active": True, "until": until}, merge=True)
+        # сразу в кэш этого инстанса; остальные узнают от on_snapshot (или по TTL)
+        premium_cache.put(uid, {"active": True, "until": until})
         bot.send_message(m.chat.id, f"✅ Премиум включён для {uid} до {until}")
         try:
             bot.send_message(uid, f"⭐ Тебе включили Premium до {until} 🙌")
@@ -1798,8 +3980,7 @@ def cmd_setpremium(m):
 @bot.message_handler(commands=['subs', 'subscribe', 'подписка'])
 def cmd_subs(m):
     _ensure_user(m.from_user)
-    doc = db.collection("users").document(str(m.from_user.id)).get()
-    d = doc.to_dict() or {}
+    d = user_profiles.get(m.from_user.id)
     sub_pod = bool(d.get("sub_pod", True))
     sub_fact = bool(d.get("sub_fact", True))
     
@@ -1817,7 +3998,7 @@ def cmd_subs_short(m):
     cmd = m.text.lstrip('/').lower()
     field = 'sub_pod' if 'pod' in cmd else 'sub_fact'
     val = cmd.endswith('on')
-    db.collection("users").document(str(m.from_user.id)).set({field: val}, merge=True)
+    user_profiles.set_fields(m.from_user.id, {field: val})
     tit = "Фраза дня" if field == 'sub_pod' else "Факт дня"
     bot.send_message(m.chat.id, f"✅ {tit}: {'включено' if val else 'выключено'}")
 
@@ -1835,7 +4016,8 @@ def handle_photo(m):
 
 @bot.message_handler(content_types=['text'])
 def handle_text(message):
-    _ensure_user(message.from_user)
+    # сначала дешёвые локальные проверки; Firestore — только в UpdateContext ниже
+    user_profiles.mark_seen(message.from_user)
     
     if not check_access(message.from_user.id):
         bot.send_message(message.chat.id, "Извини, доступ ограничен 👮‍♀️")
@@ -1873,25 +4055,22 @@ def handle_text(message):
         bot.send_message(message.chat.id, "🤔 Отправьте, пожалуйста, слово или фразу для перевода.")
         return
     
-    # 1) по количеству
-    if not can_use(user_id, "text"):
-        bot.send_message(message.chat.id, limit_msg("text"), parse_mode="Markdown")
-        return
-    
-    # 2) по символам
-    ok, why = can_use_text_volume(user_id, len(orig))
+    # карточка, премиум и счётчики — одним чтением; запись карточки — одним commit
+    with UpdateContext(message.from_user) as ctx:
+        # лимиты: штуки и символы — одним шагом
+        ok, why, _ = admit(user_id, "text", len(orig), premium=ctx.premium)
     if not ok:
-        bot.send_message(message.chat.id, why)
+        bot.send_message(message.chat.id, why, parse_mode="Markdown")
         return
     
     try:
         user_translations[message.chat.id] = orig
-        translated_text = translate_text(orig)
+        translated_text, reply = translate_local_first(orig)
         user_engine[message.chat.id] = "google"
         
         bot.send_message(
             message.chat.id,
-            f"📘 Перевод:\n*{translated_text}*",
+            reply,
             reply_markup=get_keyboard(),
             parse_mode='Markdown'
         )
@@ -1902,7 +4081,7 @@ def handle_text(message):
 
 @bot.message_handler(content_types=['voice', 'audio', 'document'])
 def handle_voice(message):
-    _ensure_user(message.from_user)
+    user_profiles.mark_seen(message.from_user)
     
     if not check_access(message.from_user.id):
         bot.send_message(message.chat.id, "Извини, доступ ограничен 👮‍♀️")
@@ -1918,10 +4097,12 @@ def handle_voice(message):
         return
     
     user_id = message.from_user.id
-    
-    # 1) по количеству
-    if not can_use(user_id, "audio"):
-        bot.send_message(message.chat.id, limit_msg("audio"), parse_mode="Markdown")
+
+    # 0) перегрузка — место в очереди занимаем до лимитов: отказ по нагрузке их не тратит,
+    #    а между проверкой и постановкой его уже никто не займёт
+    ahead = transcode_pool.admit()
+    if ahead is None:
+        bot.send_message(message.chat.id, AUDIO_BUSY_MSG)
         return
     
     # длительность
@@ -1931,13 +4112,21 @@ def handle_voice(message):
     elif message.content_type == 'audio' and message.audio:
         duration = int(message.audio.duration or 0)
     
-    # 2) по секундам
-    ok, why = can_use_audio_volume(user_id, duration)
+    try:
+        with UpdateContext(message.from_user) as ctx:
+            premium = ctx.premium
+            # лимиты: штуки и секунды — одним шагом
+            ok, why, _ = admit(user_id, "audio", duration, premium=premium)
+    except Exception:
+        transcode_pool.release()
+        raise
     if not ok:
-        bot.send_message(message.chat.id, why)
+        transcode_pool.release()
+        bot.send_message(message.chat.id, why, parse_mode="Markdown")
         return
     
-    process_audio(message)
+    # премиум секундами не ограничен — возвращать нечего
+    submit_audio_job(message, charged_secs=0 if premium else duration, ahead=ahead)
 
 # ===== CALLBACK HANDLERS =====
 
@@ -2112,10 +4301,8 @@ def handle_callback(call):
             val = (action == "on")
             uid = str(call.from_user.id)
             
-            db.collection("users").document(uid).set({field: val}, merge=True)
-            
-            doc = db.collection("users").document(uid).get()
-            d = doc.to_dict() or {}
+            user_profiles.set_fields(uid, {field: val})
+            d = user_profiles.get(uid)
             sub_pod = bool(d.get("sub_pod", True))
             sub_fact = bool(d.get("sub_fact", True))
             
@@ -2148,29 +4335,8 @@ def handle_callback(call):
             bot.send_message(call.message.chat.id, "Нет текста для объяснения.")
             return
         
-        sys_prompt = (
-    "Ты — опытный преподаватель разговорного иврита. Отвечай по-русски. "
-    "Проанализируй фразу на иврите: переведи естественно, выдели корень, биньян, "
-    "грамматическую форму глаголов; объясни сленг/идиомы и происхождение; "
-    "дай короткий пример использования. Пиши кратко и по делу."
-)
-
-        
         try:
-            answer = ask_gpt(
-                [{"role": "system", "content": sys_prompt}, {"role": "user", "content": text}],
-                model=os.getenv("OPENAI_MODEL", "gpt-4o"),
-            )
-            if answer is None:
-                local = explain_local(text)
-                _send_explanation_guard(call.message.chat.id, local, offline=True)
-            else:
-                _send_explanation_guard(call.message.chat.id, answer, offline=False)
-        except AuthenticationError:
-            bot.send_message(call.message.chat.id, "⚠️ Проблема с ключом OpenAI. Проверь OPENAI_API_KEY.")
-        except BadRequestError as e:
-            print(f"[ask_gpt] BadRequest: {e}")
-            bot.send_message(call.message.chat.id, "⚠️ Не удалось разобрать запрос для объяснения.")
+            explain_async(call.message.chat.id, text, user_id=call.from_user.id)
         except Exception as e:
             print(f"Неожиданная ошибка при объяснении: {e}")
             local = explain_local(text)
@@ -2202,15 +4368,15 @@ def handle_callback(call):
         if 'forwarded_text' in chat_data:
             text = chat_data['forwarded_text']
             user_translations[call.message.chat.id] = text
-            translated_text = translate_text(text)
+            translated_text, reply = translate_local_first(text)
             bot.send_message(
                 call.message.chat.id,
-                f"📘 Перевод:\n*{translated_text}*",
+                reply,
                 reply_markup=get_keyboard(),
                 parse_mode='Markdown'
             )
         elif 'forwarded_audio' in chat_data:
-            process_audio(chat_data['forwarded_audio'])
+            submit_audio_job(chat_data['forwarded_audio'])
         
         if call.message.chat.id in user_data:
             del user_data[call.message.chat.id]
@@ -2224,6 +4390,15 @@ def handle_callback(call):
 def signal_handler(sig, frame):
     print('\n🛑 Получен сигнал завершения. Останавливаю бота...')
     bot.stop_polling()
+    try:
+        n = usage_ledger.flush()
+        print(f"[usage] записала перед выходом: {n} док.")
+    except Exception as e:
+        print(f"[usage] flush при выходе не удался: {e}")
+    try:
+        user_profiles.flush()
+    except Exception as e:
+        print(f"[users] flush при выходе не удался: {e}")
     sys.exit(0)
 
 signal.signal(signal.SIGINT, signal_handler)
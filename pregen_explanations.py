@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Пакетная пред-генерация объяснений «🧠 Объяснить» для всех курируемых фраз и фактов.
+Бот читает готовый файл при старте и отдаёт объяснение из словаря — без вызова GPT.
+
+Запуск:  python pregen_explanations.py [--concurrency 3] [--rpm 60] [--only phrases|facts] [--limit N]
+
+Файл результата служит и чекпоинтом: при повторном запуске уже готовые фразы пропускаются.
+Если поменяли EXPLAIN_SYS_PROMPT — старые объяснения не подходят, файл собирается заново.
+"""
+import argparse, hashlib, json, os, random, threading, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dotenv import load_dotenv
+from dedupe_phrases import norm_he
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_OUT = os.path.join(BASE_DIR, "explanations.pregen.json")
+
+EXPLAIN_SYS_PROMPT = (
+    "Ты — опытный преподаватель разговорного иврита. Отвечай по-русски. "
+    "Проанализируй фразу на иврите: переведи естественно, выдели корень, биньян, "
+    "грамматическую форму глаголов; объясни сленг/идиомы и происхождение; "
+    "дай короткий пример использования. Пиши кратко и по делу."
+)
+
+
+def prompt_hash(prompt: str) -> str:
+    return hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:12]
+
+
+def norm_key(s: str) -> str:
+    # та же нормализация, что norm_text_key в main.py
+    return " ".join(norm_he(s).split())
+
+
+def load_pregenerated(path: str, prompt: str = EXPLAIN_SYS_PROMPT) -> dict:
+    """{нормализованный иврит: объяснение}; пусто, если файла нет или он собран под другой промпт."""
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except Exception as e:
+        print(f"[pregen] не смогла прочитать {path}: {e}")
+        return {}
+    if data.get("prompt_hash") != prompt_hash(prompt):
+        print(f"[pregen] {path} собран под другой промпт — игнорирую")
+        return {}
+    items = data.get("items") or {}
+    print(f"[pregen] загружено {len(items)} готовых объяснений из {path}")
+    return items
+
+
+def _load_list(path: str) -> list:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, list) else []
+    except Exception as e:
+        print(f"⚠️ {path}: {e}")
+        return []
+
+
+def collect_texts(only: str = None) -> list:
+    texts = []
+    if only in (None, "phrases"):
+        path = os.getenv("PHRASES_FILE", os.path.join(BASE_DIR, "phrases.json"))
+        texts += [x.get("he") for x in _load_list(path)]
+    if only in (None, "facts"):
+        path = os.getenv("FACTS_FILE", "").strip() or "facts.categorized.json"
+        path = path if os.path.isabs(path) else os.path.join(BASE_DIR, path)
+        texts += [x.get("he") for x in _load_list(path)]
+    seen, out = set(), []
+    for t in texts:
+        k = norm_key(t or "")
+        if k and k not in seen:
+            seen.add(k)
+            out.append(t.strip())
+    return out
+
+
+class RateLimiter:
+    """Не чаще rpm стартов в минуту на весь процесс; после 429 — общая пауза."""
+
+    def __init__(self, rpm: float):
+        self.interval = 60.0 / max(rpm, 1)
+        self.next_at = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_at)
+            self.next_at = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+    def backoff(self, seconds: float):
+        with self.lock:
+            self.next_at = max(self.next_at, time.time() + seconds)
+
+
+def explain_one(client, limiter: RateLimiter, model: str, text: str, max_retries: int = 6):
+    from openai import RateLimitError, APIConnectionError, APIStatusError, AuthenticationError, BadRequestError
+    delay = 2.0
+    for attempt in range(1, max_retries + 1):
+        limiter.acquire()
+        try:
+            resp = client.chat.completions.create(
+                model=model,
+                messages=[{"role": "system", "content": EXPLAIN_SYS_PROMPT}, {"role": "user", "content": text}],
+                temperature=0.4,
+                timeout=60,
+                max_tokens=300,
+            )
+            return resp.choices[0].message.content.strip()
+        except (AuthenticationError, BadRequestError):
+            raise
+        except RateLimitError as e:
+            print(f"⏳ 429 (попытка {attempt}/{max_retries}): {e}")
+            limiter.backoff(delay)
+        except (APIConnectionError, APIStatusError) as e:
+            print(f"⚠️ API error (попытка {attempt}/{max_retries}): {e}")
+        time.sleep(delay + random.uniform(0, 0.5))
+        delay = min(delay * 2, 60)
+    return None
+
+
+def save(path: str, model: str, items: dict):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"prompt_hash": prompt_hash(EXPLAIN_SYS_PROMPT), "model": model, "items": items},
+                  f, ensure_ascii=False, indent=1)
+    os.replace(tmp, path)
+
+
+def main():
+    load_dotenv()
+    ap = argparse.ArgumentParser(description="Пред-генерация объяснений для фраз и фактов")
+    ap.add_argument("--out", default=os.getenv("PREGEN_FILE") or DEFAULT_OUT)
+    ap.add_argument("--model", default=os.getenv("OPENAI_MODEL", "gpt-4o"))
+    ap.add_argument("--concurrency", type=int, default=3)
+    ap.add_argument("--rpm", type=float, default=60)
+    ap.add_argument("--only", choices=["phrases", "facts"])
+    ap.add_argument("--limit", type=int, default=0)
+    ap.add_argument("--checkpoint-every", type=int, default=10)
+    args = ap.parse_args()
+
+    from openai import OpenAI
+    client = OpenAI(api_key=(os.getenv("OPENAI_API_KEY") or "").strip(), timeout=60)
+
+    items = load_pregenerated(args.out)
+    todo = [t for t in collect_texts(args.only) if norm_key(t) not in items]
+    if args.limit:
+        todo = todo[:args.limit]
+    print(f"📚 Уже готово: {len(items)}, осталось: {len(todo)} (model={args.model}, потоков={args.concurrency}, rpm={args.rpm:g})")
+
+    limiter = RateLimiter(args.rpm)
+    done = failed = 0
+    ex = ThreadPoolExecutor(max_workers=args.concurrency)
+    try:
+        futs = {ex.submit(explain_one, client, limiter, args.model, t): t for t in todo}
+        for fut in as_completed(futs):
+            text = futs[fut]
+            try:
+                answer = fut.result()
+            except Exception as e:
+                print(f"❌ {text[:40]}: {e}")
+                answer = None
+            if answer:
+                items[norm_key(text)] = answer
+                done += 1
+                if done % args.checkpoint_every == 0:
+                    save(args.out, args.model, items)
+                    print(f"💾 чекпоинт: {done}/{len(todo)}")
+            else:
+                failed += 1
+    finally:
+        # Ctrl+C тоже сюда: недоделанное отменяем, готовое сохраняем — следующий запуск продолжит
+        ex.shutdown(wait=False, cancel_futures=True)
+        save(args.out, args.model, items)
+    print(f"✅ Готово: +{done}, ошибок {failed}. Всего в файле: {len(items)} → {args.out}")
+
+
+if __name__ == "__main__":
+    main()